@@ -6,47 +6,1176 @@ import binascii
 import glob
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import shutil
 import time
 import threading
 import concurrent.futures
-from collections import OrderedDict
-from urllib.parse import urlparse, urljoin
+import asyncio
+import argparse
+import itertools
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from urllib.parse import urlparse, urljoin, parse_qsl, urlencode
 import json
+import hashlib
+import random
+import io
+import importlib.util
+from array import array
+from email.utils import parsedate_to_datetime
+
+aiohttp = None # Optional and slow to import, so only loaded by load_aiohttp() for --engine async
+
+def load_aiohttp():
+    """Imports aiohttp on first use. Returns the module, or None if it is not installed."""
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp as module
+        except ImportError:
+            return None
+        aiohttp = module
+    return aiohttp
 
 class Downloader:
     def __init__(self):
         self.completed = 0
         self.total = 0
-        self.failed = 0
+        self.failed = 0  # Segments that gave up after all retries
+        self.retries = 0 # Transient failures that were retried
+        self.invalid = 0 # Bodies rejected by verification and downloaded again
+        self.total_duration = 0.0     # Seconds of video in all segments, from #EXTINF
+        self.completed_duration = 0.0
+        self.bytes_received = 0
+        self.latencies = deque(maxlen=1000) # Seconds per successful request, the last 1000 (oldest dropped first)
+        self.hosts = {}  # host -> {'bytes', 'seconds', 'segments'}
         self.lock = threading.Lock()
         self.start_time = time.time()
 
-    def print_progress(self, lang_strings):
-        """Prints the download progress."""
+    def mark_completed(self, duration=0.0):
+        """Counts a finished segment holding `duration` seconds of video."""
         with self.lock:
-            if self.total == 0:
-                return
-            elapsed = time.time() - self.start_time
-            percent = (self.completed / self.total) * 100
-            if self.completed > 0:
-                time_per_file = elapsed / self.completed
-                eta = (self.total - self.completed) * time_per_file
-            else:
-                eta = 0
-                
-            sys.stdout.write("\r")
+            self.completed += 1
+            self.completed_duration += duration
+
+    def record_transfer(self, url, received, latency):
+        """Records `received` bytes fetched from url by a request that took `latency` seconds."""
+        host = urlparse(url).netloc
+        with self.lock:
+            self.bytes_received += received
+            self.latencies.append(latency)
+            stats = self.hosts.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'segments': 0})
+            stats['bytes'] += received
+            stats['seconds'] += latency
+            stats['segments'] += 1
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class ProgressReporter:
+    """Renders the progress of one or more Downloaders at a fixed rate from a single thread."""
+    def __init__(self, downloaders, lang_strings, controller=None, interval=0.5, metrics_file=None, smoothing=0.2, callback=None, quiet=False):
+        self.downloaders = downloaders
+        self.quiet = quiet # Only the callback and the metrics file get the progress
+        self.callback = callback # Called with the stats of every tick, e.g. by library users
+        self.lang_strings = lang_strings
+        self.controller = controller
+        self.interval = interval
+        self.smoothing = smoothing # Weight of the newest sample in the moving average
+        self.metrics = open(metrics_file, 'a', encoding='utf-8') if metrics_file else None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.last_bytes = 0
+        self.last_time = time.time()
+        self.rate = 0.0
+        self.average_rate = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stops the reporter after rendering the final state."""
+        self.stop_event.set()
+        self.thread.join()
+        self.report()
+        if self.metrics is not None:
+            self.metrics.close()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def snapshot(self):
+        """Sums the counters of all downloaders."""
+        totals = {'completed': 0, 'total': 0, 'failed': 0, 'retries': 0, 'bytes': 0,
+                  'total_duration': 0.0, 'completed_duration': 0.0}
+        latencies = []
+        hosts = {}
+        start_time = time.time()
+        for downloader in self.downloaders:
+            with downloader.lock:
+                totals['completed'] += downloader.completed
+                totals['total'] += downloader.total
+                totals['failed'] += downloader.failed
+                totals['retries'] += downloader.retries
+                totals['bytes'] += downloader.bytes_received
+                totals['total_duration'] += downloader.total_duration
+                totals['completed_duration'] += downloader.completed_duration
+                latencies.extend(downloader.latencies)
+                for host, stats in downloader.hosts.items():
+                    merged = hosts.setdefault(host, {'bytes': 0, 'seconds': 0.0, 'segments': 0})
+                    for key in merged:
+                        merged[key] += stats[key]
+                start_time = min(start_time, downloader.start_time)
+        latencies.sort()
+        totals['latency_p50'] = percentile(latencies, 0.5)
+        totals['latency_p90'] = percentile(latencies, 0.9)
+        totals['latency_p99'] = percentile(latencies, 0.99)
+        totals['hosts'] = hosts
+        totals['elapsed'] = time.time() - start_time
+        return totals
+
+    def report(self):
+        stats = self.snapshot()
+        now = time.time()
+        # Instantaneous throughput over the last tick, smoothed into a moving average
+        self.rate = (stats['bytes'] - self.last_bytes) / max(now - self.last_time, 1e-6)
+        if self.average_rate is None:
+            self.average_rate = self.rate
+        else:
+            self.average_rate = self.smoothing * self.rate + (1 - self.smoothing) * self.average_rate
+        self.last_bytes = stats['bytes']
+        self.last_time = now
+        if not self.quiet:
+            self.print_progress(stats)
+        if self.callback is not None:
+            self.callback(dict(stats, rate_bps=self.rate, average_rate_bps=self.average_rate))
+        if self.metrics is not None:
+            self.write_metrics(stats, now)
+
+    def print_progress(self, stats):
+        """Prints the download progress."""
+        lang_strings = self.lang_strings
+        if stats['total'] == 0:
+            return
+        elapsed = stats['elapsed']
+        completed = stats['completed']
+        percent = (completed / stats['total']) * 100
+        if stats['completed_duration'] > 0 and stats['total_duration'] > 0:
+            # Segments differ in length, so estimate from seconds of video rather than segment count
+            eta = elapsed * (stats['total_duration'] - stats['completed_duration']) / stats['completed_duration']
+        elif completed > 0:
+            time_per_file = elapsed / completed
+            eta = (stats['total'] - completed) * time_per_file
+        else:
+            eta = 0
+            
+        sys.stdout.write("\r")
+        sys.stdout.write(
+            lang_strings["download_progress"].format(
+                completed=completed,
+                total=stats['total'],
+                percent=percent,
+                failed=stats['failed'],
+                retries=stats['retries'],
+                elapsed=elapsed/60,
+                eta=eta/60
+            )
+        )
+        sys.stdout.write(
+            lang_strings["throughput_status"].format(
+                mb=stats['bytes'] / (1024 * 1024),
+                rate=self.rate / (1024 * 1024),
+                average=self.average_rate / (1024 * 1024),
+                p50=stats['latency_p50'],
+                p90=stats['latency_p90']
+            )
+        )
+        if self.controller is not None:
             sys.stdout.write(
-                lang_strings["download_progress"].format(
-                    completed=self.completed,
-                    total=self.total,
-                    percent=percent,
-                    failed=self.failed,
-                    elapsed=elapsed/60,
-                    eta=eta/60
+                lang_strings["concurrency_status"].format(
+                    limit=self.controller.limit,
+                    reason=lang_strings["concurrency_reason_" + self.controller.reason]
                 )
             )
-            sys.stdout.flush()
+        sys.stdout.flush()
+
+    def write_metrics(self, stats, now):
+        """Appends one JSON line of metrics, including per-host throughput to spot slow CDN edges."""
+        record = {
+            'time': now,
+            'elapsed': stats['elapsed'],
+            'completed': stats['completed'],
+            'total': stats['total'],
+            'failed': stats['failed'],
+            'retries': stats['retries'],
+            'bytes': stats['bytes'],
+            'rate_bps': self.rate,
+            'average_rate_bps': self.average_rate,
+            'latency_p50': stats['latency_p50'],
+            'latency_p90': stats['latency_p90'],
+            'latency_p99': stats['latency_p99'],
+            'workers': self.controller.limit if self.controller is not None else None,
+            'hosts': {
+                host: {
+                    'bytes': host_stats['bytes'],
+                    'segments': host_stats['segments'],
+                    'rate_bps': host_stats['bytes'] / host_stats['seconds'] if host_stats['seconds'] else 0.0,
+                    'latency_avg': host_stats['seconds'] / host_stats['segments'] if host_stats['segments'] else 0.0
+                }
+                for host, host_stats in stats['hosts'].items()
+            }
+        }
+        self.metrics.write(json.dumps(record) + '\n')
+        self.metrics.flush()
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the requests it sends and the connections it opens, however long its pools live."""
+    def __init__(self, *args, **kwargs):
+        self.counts_lock = threading.Lock()
+        self.opened = 0
+        self.sent = 0
+        super().__init__(*args, **kwargs)
+
+    def count(self, name):
+        with self.counts_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.count_connections(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        self.count_connections(manager)
+        return manager
+
+    def count_connections(self, manager):
+        """Makes the host pools that manager creates from now on count each connection they open."""
+        if getattr(manager, 'counted_by', None) is self:
+            return
+        manager.counted_by = self
+        manager.pool_classes_by_scheme = {scheme: self.counting_pool(pool_class)
+                                          for scheme, pool_class in manager.pool_classes_by_scheme.items()}
+
+    def counting_pool(self, pool_class):
+        adapter = self
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                adapter.count('opened')
+                super().connect()
+        return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+
+    def send(self, request, **kwargs):
+        self.count('sent')
+        return super().send(request, **kwargs)
+
+class SessionPool:
+    """Thread-local keep-alive sessions sharing one pooled HTTP adapter."""
+    def __init__(self, max_workers=10, pool_hosts=10):
+        # urllib3's PoolManager is thread-safe, so every worker session mounts
+        # the same adapter and draws from the same per-host connection pools.
+        self.adapter = CountingAdapter(pool_connections=pool_hosts, pool_maxsize=max_workers, pool_block=True)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def session(self):
+        """Returns the session owned by the calling thread."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def get(self, url, headers=None, **kwargs):
+        """Issues a GET request over a pooled connection."""
+        if headers:
+            # Older config.json files still carry 'Connection: close', which
+            # would defeat connection reuse.
+            headers = {k: v for k, v in headers.items() if k.lower() != 'connection'}
+        return self.session().get(url, headers=headers, **kwargs)
+
+    def stats(self):
+        """Returns (connections opened, requests sent) across all hosts."""
+        with self.adapter.counts_lock:
+            return self.adapter.opened, self.adapter.sent
+
+    def close(self):
+        """Closes all sessions and their pooled connections."""
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+        self.adapter.close()
+
+class ConcurrencyController:
+    """AIMD limit on concurrent segment downloads, adjusted from the outcome of each request."""
+    def __init__(self, initial=10, minimum=2, maximum=32):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.reason = 'initial'
+        self.active = 0
+        self.condition = threading.Condition()
+        self.best_latency = None
+        self.last_throughput = None
+        self.last_decrease = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_successes = 0
+        self.window_errors = 0
+
+    def acquire(self):
+        """Blocks until fewer than `limit` downloads are in flight."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record_success(self, received, latency):
+        """Records a finished segment of `received` bytes that took `latency` seconds."""
+        with self.condition:
+            self.window_successes += 1
+            self.window_bytes += received
+            self.window_latency += latency
+            self._maybe_adjust()
+
+    def record_error(self, throttled=False):
+        """Records a failed attempt; throttling (HTTP 429) halves the limit immediately."""
+        with self.condition:
+            if throttled:
+                self._decrease('throttled')
+                return
+            self.window_errors += 1
+            self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        # Judge the link once per `limit` outcomes, i.e. roughly once per round of workers
+        outcomes = self.window_successes + self.window_errors
+        if outcomes < self.limit:
+            return
+        elapsed = max(time.time() - self.window_start, 1e-6)
+        throughput = self.window_bytes / elapsed
+        latency = self.window_latency / self.window_successes if self.window_successes else None
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+
+        if self.window_errors / outcomes > 0.1:
+            self._decrease('errors')
+        elif latency is not None and latency > 3 * self.best_latency and self.limit > self.minimum:
+            # Requests are queueing up somewhere: back off gently
+            self.limit -= 1
+            self.reason = 'latency'
+        elif (self.reason == 'ramp_up' and self.last_throughput is not None
+              and throughput < self.last_throughput * 0.95 and self.limit > self.minimum):
+            # The last increase did not pay off
+            self.limit -= 1
+            self.reason = 'plateau'
+        elif self.limit < self.maximum:
+            self.limit += 1
+            self.reason = 'ramp_up'
+            self.condition.notify()
+        self.last_throughput = throughput
+        self._reset_window()
+
+    def _decrease(self, reason):
+        # One burst of errors from a full round of workers should only halve the limit once
+        now = time.time()
+        if now - self.last_decrease < 2:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit // 2)
+        self.reason = reason
+        self._reset_window()
+
+CONGESTION_ERRORS = ('throttled', 'server', 'timeout', 'connection') # RetryPolicy.classify() kinds that signal overload
+
+class RetryPolicy:
+    """Decides whether and when a failed segment request is retried, shared by all workers."""
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=30.0, budget_ratio=0.2, budget_minimum=10,
+                 breaker_threshold=10, breaker_cooldown=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio       # Retries allowed per request sent to a host...
+        self.budget_minimum = budget_minimum   # ...on top of this many
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = {'requests': 0, 'retries': 0, 'consecutive_failures': 0, 'open_until': 0}
+        return self.hosts[host]
+
+    @staticmethod
+    def classify(error):
+        """Returns 'throttled', 'client', 'server', 'timeout', 'connection' or 'incomplete' for a failed attempt."""
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+        if status == 429:
+            return 'throttled'
+        if status is not None and 400 <= status < 500:
+            return 'timeout' if status == 408 else 'client'
+        if status is not None and status >= 500:
+            return 'server'
+        if isinstance(error, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+            return 'timeout'
+        if isinstance(error, IncompleteSegmentError):
+            return 'incomplete'
+        return 'connection'
+
+    @staticmethod
+    def retry_after(error):
+        """Returns the delay requested by a Retry-After header, in seconds, or None."""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def before_attempt(self, url):
+        """Counts a request to the host of url and returns how long to wait while its circuit is open."""
+        with self.lock:
+            state = self._host(url)
+            state['requests'] += 1
+            return max(0.0, state['open_until'] - time.time())
+
+    def record_success(self, url):
+        with self.lock:
+            self._host(url)['consecutive_failures'] = 0
+
+    def next_delay(self, url, error, attempt):
+        """Records a failed attempt and returns the delay before retrying, or None to give up."""
+        kind = self.classify(error)
+        with self.lock:
+            state = self._host(url)
+            state['consecutive_failures'] += 1
+            if state['consecutive_failures'] >= self.breaker_threshold:
+                # Stop hammering a host that keeps failing: its requests all wait out the cooldown, then resume,
+                # and one more failure opens the circuit again
+                state['open_until'] = time.time() + self.breaker_cooldown
+                state['consecutive_failures'] = self.breaker_threshold - 1
+            if kind == 'client' or attempt + 1 >= self.max_retries:
+                return None
+            if state['retries'] >= self.budget_minimum + self.budget_ratio * state['requests']:
+                return None # Retry budget for this host is spent
+            state['retries'] += 1
+
+        retry_after = self.retry_after(error) if kind in ('throttled', 'server') else None
+        if retry_after is not None:
+            # A Retry-After of minutes or a date far ahead must not park the worker for that long
+            return min(retry_after, self.max_delay)
+        if kind == 'connection' and attempt == 0:
+            return random.uniform(0, self.base_delay / 4) # A reset keep-alive connection, retry right away
+        # Full jitter keeps workers that failed together from retrying together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt + 1)))
+
+AUTH_ERROR_STATUSES = (401, 403)
+
+class HeaderProvider(Mapping):
+    """Request headers shared by all download workers, renewed by `refresher` when they expire.
+
+    Each request uses one immutable snapshot of the headers. A refresh swaps in a new snapshot and bumps its
+    generation, so workers that failed with older headers wait for it instead of refreshing again themselves.
+    """
+    def __init__(self, headers, refresher=None, refresh_interval=0, min_interval=10, lang_strings=None, log=print):
+        self.snapshot = (dict(headers), 0) # (headers, generation), replaced as a whole
+        self.refresher = refresher # Returns the changed headers as a dict
+        self.refresh_interval = refresh_interval # Seconds between proactive refreshes, 0 to refresh only on 401/403
+        self.min_interval = min_interval # Rejected new headers must not start a refresh loop
+        self.lang_strings = lang_strings
+        self.log = log
+        self.refreshed_at = 0.0
+        self.attempted_at = 0.0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        """Returns (headers, generation) for one request, refreshing them first when refresh_interval has passed."""
+        now = time.time()
+        if (self.refresher is not None and self.refresh_interval and now - self.refreshed_at >= self.refresh_interval
+                and now - self.attempted_at >= self.min_interval):
+            self.refresh(self.snapshot[1])
+        return self.snapshot
+
+    def refresh(self, generation):
+        """Renews the headers unless that already happened after `generation`. Returns True if newer headers are in place.
+
+        Workers calling this wait on the lock while another one refreshes.
+        """
+        with self.lock:
+            headers, current = self.snapshot
+            if current != generation:
+                return True
+            if self.refresher is None or time.time() - self.attempted_at < self.min_interval:
+                return False
+            self.attempted_at = time.time()
+            try:
+                updates = self.refresher()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if self.lang_strings:
+                    self.log(self.lang_strings["auth_refresh_failed"].format(error=e))
+                return False
+            headers = dict(headers)
+            headers.update(updates)
+            self.snapshot = (headers, current + 1)
+            self.refreshed_at = time.time()
+            self.refreshes += 1
+        if self.lang_strings:
+            self.log(self.lang_strings["auth_refreshed"].format(names=', '.join(sorted(updates))))
+        return True
+
+    def __getitem__(self, name):
+        return self.snapshot[0][name]
+
+    def __iter__(self):
+        return iter(self.snapshot[0])
+
+    def __len__(self):
+        return len(self.snapshot[0])
+
+def header_snapshot(headers, exclude=()):
+    """Returns (headers, generation) for one request from a dict or HeaderProvider, without the names in exclude (lower case)."""
+    if isinstance(headers, HeaderProvider):
+        headers, generation = headers.current()
+    else:
+        generation = 0
+    if exclude:
+        headers = {k: v for k, v in headers.items() if k.lower() not in exclude}
+    return headers, generation
+
+def refresh_expired_headers(headers, error, generation):
+    """Refreshes a HeaderProvider after a 401/403 response. Returns True if the request should be retried at once."""
+    if not isinstance(headers, HeaderProvider):
+        return False
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+    return status in AUTH_ERROR_STATUSES and headers.refresh(generation)
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `burst`; a rate of 0 means unlimited."""
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            # A quarter second of tokens keeps the flow smooth instead of bursty
+            self.burst = burst or max(rate / 4, 1)
+            self.tokens = min(max(getattr(self, 'tokens', self.burst), 0), self.burst) # Old debt does not carry over
+            self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        """Takes `amount` tokens, going into debt if there are not enough, and returns the seconds to wait for them."""
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0.0)
+
+class RateLimiter:
+    """Global and per-host bytes/s and requests/s limits shared by all download workers.
+
+    The limits are re-read from the 'rate_limit' section of config_file when it changes, so they can be adjusted while
+    a download is running.
+    """
+    RELOAD_INTERVAL = 1.0
+
+    def __init__(self, bytes_per_second=0, requests_per_second=0, host_bytes_per_second=0, host_requests_per_second=0,
+                 config_file=None):
+        self.lock = threading.Lock()
+        self.global_bytes = TokenBucket()
+        self.global_requests = TokenBucket()
+        self.hosts = {}  # host -> (bytes bucket, requests bucket)
+        self.config_file = config_file
+        self.config_mtime = os.path.getmtime(config_file) if config_file and os.path.exists(config_file) else None
+        self.next_reload = time.monotonic() + self.RELOAD_INTERVAL
+        self.set_limits(bytes_per_second, requests_per_second, host_bytes_per_second, host_requests_per_second)
+
+    def set_limits(self, bytes_per_second=0, requests_per_second=0, host_bytes_per_second=0, host_requests_per_second=0):
+        """Changes the limits of running downloads; 0 removes a limit."""
+        with self.lock:
+            self.host_bytes_per_second = host_bytes_per_second
+            self.host_requests_per_second = host_requests_per_second
+            self.global_bytes.set_rate(bytes_per_second)
+            self.global_requests.set_rate(requests_per_second)
+            for bytes_bucket, requests_bucket in self.hosts.values():
+                bytes_bucket.set_rate(host_bytes_per_second)
+                requests_bucket.set_rate(host_requests_per_second)
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            buckets = self.hosts.get(host)
+            if buckets is None:
+                buckets = (TokenBucket(self.host_bytes_per_second), TokenBucket(self.host_requests_per_second))
+                self.hosts[host] = buckets
+            return buckets
+
+    def _reload(self):
+        now = time.monotonic()
+        if self.config_file is None or now < self.next_reload:
+            return
+        self.next_reload = now + self.RELOAD_INTERVAL
+        try:
+            mtime = os.path.getmtime(self.config_file)
+            if mtime == self.config_mtime:
+                return
+            self.config_mtime = mtime
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                settings = json.load(f).get('rate_limit', {})
+        except (OSError, ValueError):
+            return # Keep the current limits while the file is being edited
+        self.set_limits(**{k: settings.get(k, 0) for k in ('bytes_per_second', 'requests_per_second',
+                                                           'host_bytes_per_second', 'host_requests_per_second')})
+
+    def request_delay(self, url):
+        """Reserves one request and returns the seconds to wait before sending it."""
+        self._reload()
+        return max(self.global_requests.reserve(1), self._host(url)[1].reserve(1))
+
+    def transfer_delay(self, url, amount):
+        """Reserves `amount` received bytes and returns the seconds to wait before reading more."""
+        return max(self.global_bytes.reserve(amount), self._host(url)[0].reserve(amount))
+
+    def read_size(self, url, chunk_size):
+        """Caps chunk_size to the burst of the active byte limits, so no single read overshoots them."""
+        bursts = [bucket.burst for bucket in (self.global_bytes, self._host(url)[0]) if bucket.rate]
+        return max(int(min(bursts + [chunk_size])), 1)
+
+class TransferSettings:
+    """How segment bodies are read: the chunk size, the rate limits, and when a large segment is split into parallel Range requests."""
+    def __init__(self, chunk_size=256 * 1024, split_threshold=8 * 1024 * 1024, split_parts=4, limiter=None):
+        self.chunk_size = chunk_size
+        self.split_threshold = split_threshold # Segments of at least this many bytes are split...
+        self.split_parts = split_parts         # ...into this many connections
+        self.limiter = limiter
+        self.part_executor = None # Fetches the extra parts of split segments, shared by all of them; see start_part_workers()
+
+    def before_request(self, url):
+        """Blocks until the rate limiter allows another request."""
+        if self.limiter is not None:
+            delay = self.limiter.request_delay(url)
+            if delay:
+                time.sleep(delay)
+
+    def throttle(self, url, amount):
+        """Blocks until the rate limiter allows `amount` more bytes; called for every chunk read."""
+        if self.limiter is not None:
+            delay = self.limiter.transfer_delay(url, amount)
+            if delay:
+                time.sleep(delay)
+
+    def read_size(self, url):
+        """Returns how many bytes to read at a time from a body of url."""
+        if self.limiter is None:
+            return self.chunk_size
+        return self.limiter.read_size(url, self.chunk_size)
+
+    def iter_body(self, response, url):
+        """Yields the chunks of a streamed response body, paced by the rate limiter."""
+        for chunk in response.iter_content(chunk_size=self.read_size(url)):
+            self.throttle(url, len(chunk))
+            yield chunk
+
+    def split_ranges(self, size):
+        """Returns the (offset, length) parts to fetch a body of `size` bytes in, or None to fetch it in one request."""
+        if size is None or self.split_parts < 2 or size < self.split_threshold:
+            return None
+        part_size = -(-size // self.split_parts)
+        return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+    def start_part_workers(self, workers):
+        """Starts one thread pool for the extra parts of all split segments of a run, so their threads (and sessions) are reused."""
+        if self.split_parts > 1 and self.part_executor is None:
+            self.part_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        """Stops the part workers, if they were started."""
+        if self.part_executor is not None:
+            self.part_executor.shutdown()
+            self.part_executor = None
+
+class PartWriter:
+    """Writes one part of a split download sequentially from its offset, into a bytearray or a preallocated file."""
+    def __init__(self, target, offset):
+        self.target = target
+        self.position = offset
+        self.file = None
+        if not isinstance(target, bytearray):
+            self.file = open(target, 'r+b')
+            self.file.seek(offset)
+
+    def write(self, chunk):
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.target[self.position:self.position + len(chunk)] = chunk
+        self.position += len(chunk)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class SegmentAssembler:
+    """Appends downloaded segments to the output file in playlist order as they arrive."""
+    def __init__(self, output_file, spill_dir, window=64):
+        self.output = open(output_file, 'wb')
+        self.spill_dir = spill_dir
+        self.window = window
+        self.next_index = 0
+        self.pending = {}  # index -> data held in memory, within `window` of next_index
+        self.spilled = {}  # index -> temp file for segments that arrived far out of order
+        self.skipped = set()
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def write_header(self, data):
+        """Writes data (e.g. the decoded init.mp4) ahead of all segments."""
+        with self.lock:
+            self._write(data)
+
+    def add(self, index, data):
+        """Accepts the data of segment `index`, writing it out once all earlier segments are in."""
+        with self.lock:
+            if index == self.next_index:
+                self._write(data)
+                self.next_index += 1
+                self._drain()
+            elif index - self.next_index < self.window:
+                self.pending[index] = data
+            else:
+                spill_path = os.path.join(self.spill_dir, f"{index:05d}.part")
+                with open(spill_path, 'wb') as f:
+                    f.write(data)
+                self.spilled[index] = spill_path
+
+    def skip(self, index):
+        """Marks segment `index` as permanently failed so later segments are not held back."""
+        with self.lock:
+            if index == self.next_index:
+                self.next_index += 1
+                self._drain()
+            else:
+                self.skipped.add(index)
+
+    def finish(self):
+        """Flushes any remaining segments in order and closes the output file."""
+        with self.lock:
+            for index in sorted(set(self.pending) | set(self.spilled)):
+                self._write(self._take(index))
+            self.output.close()
+
+    def _drain(self):
+        while True:
+            index = self.next_index
+            if index in self.skipped:
+                self.skipped.discard(index)
+            elif index in self.pending or index in self.spilled:
+                self._write(self._take(index))
+            else:
+                break
+            self.next_index += 1
+
+    def _take(self, index):
+        if index in self.pending:
+            return self.pending.pop(index)
+        spill_path = self.spilled.pop(index)
+        with open(spill_path, 'rb') as f:
+            data = f.read()
+        os.remove(spill_path)
+        return data
+
+    def _write(self, data):
+        self.output.write(data)
+        self.bytes_written += len(data)
+
+class IncompleteSegmentError(Exception):
+    """Raised when a segment body is shorter or longer than the server announced."""
+
+class InvalidSegmentError(IncompleteSegmentError):
+    """Raised when a segment body is not a valid MPEG-TS or fMP4 segment, such as an HTML error page."""
+
+TS_PACKET_SIZE = 188
+MP4_BOX_TYPES = {b'ftyp', b'styp', b'moov', b'sidx', b'ssix', b'prft', b'emsg', b'moof', b'mdat', b'free', b'skip', b'meta', b'uuid'}
+
+def iter_boxes(data):
+    """Yields (type, payload) of the MP4 boxes in a complete buffer."""
+    offset = 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        box_type = bytes(data[offset + 4:offset + 8])
+        header = 8
+        if size == 1:
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+            header = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header or offset + size > len(data):
+            raise InvalidSegmentError(f"broken '{box_type.decode('latin-1')}' box")
+        yield box_type, data[offset + header:offset + size]
+        offset += size
+
+def init_track_ids(init_data):
+    """Returns the track IDs declared in the moov box of an fMP4 init segment, or None if it has none."""
+    track_ids = set()
+    try:
+        for box_type, moov in iter_boxes(init_data):
+            if box_type != b'moov':
+                continue
+            for trak_type, trak in iter_boxes(moov):
+                if trak_type != b'trak':
+                    continue
+                for tkhd_type, tkhd in iter_boxes(trak):
+                    if tkhd_type == b'tkhd':
+                        # version 1 has 64-bit creation and modification times before the track ID
+                        offset = 20 if tkhd[0] == 1 else 12
+                        track_ids.add(int.from_bytes(tkhd[offset:offset + 4], 'big'))
+    except (InvalidSegmentError, IndexError):
+        return None
+    return track_ids or None
+
+class SegmentVerifier:
+    """Checks a segment while it streams in: MPEG-TS sync bytes, or the fMP4 box structure with moof/mdat boxes
+    whose tracks exist in the init segment. Bodies in other formats are let through."""
+    def __init__(self, track_ids=None):
+        self.track_ids = track_ids
+        self.kind = None     # 'ts', 'mp4' or 'other', known after the first 8 bytes
+        self.head = b''
+        self.position = 0    # TS bytes checked so far
+        self.box_header = b''
+        self.box_remaining = 0
+        self.moof = None     # Body of the moof box being collected
+        self.boxes = set()
+
+    def feed(self, chunk):
+        """Checks the next chunk of the body. Raises InvalidSegmentError as soon as it is clearly broken."""
+        if self.kind is None:
+            self.head += chunk
+            if len(self.head) < 8:
+                return
+            chunk, self.head = self.head, b''
+            self.kind = self._detect(chunk)
+        if self.kind == 'ts':
+            first = (-self.position) % TS_PACKET_SIZE
+            if chunk[first::TS_PACKET_SIZE].strip(b'\x47'):
+                raise InvalidSegmentError("lost MPEG-TS sync")
+            self.position += len(chunk)
+        elif self.kind == 'mp4':
+            self._feed_mp4(memoryview(chunk))
+
+    def _detect(self, head):
+        if head[0] == 0x47:
+            return 'ts'
+        if head[4:8] in MP4_BOX_TYPES:
+            return 'mp4'
+        if head.lstrip()[:1] in (b'<', b'{'):
+            raise InvalidSegmentError("received an HTML or JSON page instead of video")
+        return 'other'
+
+    def _feed_mp4(self, chunk):
+        while len(chunk):
+            if self.box_remaining:
+                take = chunk[:self.box_remaining]
+                if self.moof is not None:
+                    self.moof += take
+                self.box_remaining -= len(take)
+                chunk = chunk[len(take):]
+                if not self.box_remaining and self.moof is not None:
+                    self._check_moof()
+                continue
+            # Box header: 8 bytes, or 16 with a 64-bit size
+            needed = 16 if len(self.box_header) >= 8 and self.box_header[:4] == b'\x00\x00\x00\x01' else 8
+            take = chunk[:needed - len(self.box_header)]
+            self.box_header += bytes(take)
+            chunk = chunk[len(take):]
+            if len(self.box_header) < needed:
+                continue
+            if needed == 8 and self.box_header[:4] == b'\x00\x00\x00\x01':
+                continue # Read the 64-bit size first
+            size = int.from_bytes(self.box_header[:4], 'big')
+            box_type = self.box_header[4:8]
+            if size == 1:
+                size = int.from_bytes(self.box_header[8:16], 'big')
+            elif size == 0:
+                size = sys.maxsize # Runs to the end of the segment
+            if size < needed or not box_type.isalnum() and box_type not in MP4_BOX_TYPES:
+                raise InvalidSegmentError("broken MP4 box structure")
+            self.boxes.add(box_type)
+            self.box_remaining = size - needed
+            self.moof = b'' if box_type == b'moof' else None
+            self.box_header = b''
+            if not self.box_remaining and self.moof is not None:
+                self._check_moof()
+
+    def _check_moof(self):
+        for box_type, traf in iter_boxes(self.moof):
+            if box_type != b'traf':
+                continue
+            for tfhd_type, tfhd in iter_boxes(traf):
+                if tfhd_type == b'tfhd' and self.track_ids:
+                    track_id = int.from_bytes(tfhd[4:8], 'big')
+                    if track_id not in self.track_ids:
+                        raise InvalidSegmentError(f"track {track_id} is not in the init segment")
+        self.moof = None
+
+    def finish(self):
+        """Checks the end of the body. Raises InvalidSegmentError if it is truncated or incomplete."""
+        if self.kind is None:
+            if self.head.lstrip()[:1] in (b'<', b'{') or not self.head:
+                raise InvalidSegmentError("empty or non-video body")
+            return
+        if self.kind == 'ts' and self.position % TS_PACKET_SIZE:
+            raise InvalidSegmentError("truncated MPEG-TS packet")
+        if self.kind == 'mp4':
+            if self.box_header or (self.box_remaining and self.box_remaining < sys.maxsize // 2):
+                raise InvalidSegmentError("truncated MP4 box")
+            if b'moov' not in self.boxes and not {b'moof', b'mdat'} <= self.boxes:
+                raise InvalidSegmentError("fMP4 segment without moof and mdat")
+
+def verify_segment_data(data, verifier):
+    """Checks a whole segment body held in memory."""
+    verifier.feed(data)
+    verifier.finish()
+
+class SegmentManifest:
+    """Append-only journal of segment downloads in the downloads directory, used by --resume."""
+    FILE_NAME = 'manifest.jsonl'
+
+    def __init__(self, downloads_dir, resume=False):
+        self.downloads_dir = downloads_dir
+        self.path = os.path.join(downloads_dir, self.FILE_NAME)
+        self.entries = {}  # segment file name -> latest record
+        self.reused = 0
+        self.lock = threading.Lock()
+        if resume:
+            self._load()
+        else:
+            self._reset()
+        self.journal = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # A torn last line from an interrupted run
+                self.entries[record['file']] = record
+
+    def _reset(self):
+        # A fresh run must not continue .part files left behind by an older one
+        for part_path in glob.glob(os.path.join(self.downloads_dir, '*.part')):
+            os.remove(part_path)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def is_complete(self, segment_path, segment_url):
+        """Returns True if segment_path was fully downloaded from the same URL by an earlier run."""
+        record = self.entries.get(os.path.basename(segment_path))
+        if not record or not record.get('complete') or record['url'] != strip_query(segment_url):
+            return False
+        try:
+            size = os.path.getsize(segment_path)
+        except OSError:
+            return False
+        if size != record['written']:
+            return False
+        with self.lock:
+            self.reused += 1
+        return True
+
+    def record(self, segment_path, segment_url, length, written, checksum, complete):
+        """Appends the state of one segment to the journal."""
+        record = {
+            'file': os.path.basename(segment_path),
+            'url': strip_query(segment_url),
+            'length': length,
+            'written': written,
+            'sha256': checksum,
+            'complete': complete
+        }
+        with self.lock:
+            self.entries[record['file']] = record
+            self.journal.write(json.dumps(record) + '\n')
+            self.journal.flush()
+
+    def close(self):
+        """Compacts the journal to one record per segment, replacing it atomically."""
+        with self.lock:
+            self.journal.close()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in self.entries.values():
+                    f.write(json.dumps(record) + '\n')
+            os.replace(tmp_path, self.path)
+
+def strip_query(url):
+    """Drops the query string, which often carries per-session tokens."""
+    return urlparse(url)._replace(query='', fragment='').geturl()
+
+def link_or_copy(source_path, target_path):
+    """Hard-links source_path to target_path, copying it when linking is not possible."""
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+class SegmentCache:
+    """Content-addressed segment store shared across runs, with least-recently-used eviction above a size cap.
+
+    keys/ maps each normalized segment URL to the sha256 of its content, and objects/ holds every content once,
+    so titles sharing intros or ads reuse the same file.
+    """
+    # Query parameters that carry per-session tokens rather than select content
+    DEFAULT_STRIP_PARAMS = r'(?i)^(token|sign|signature|auth_key|hdnts|policy|key-pair-id|expires?|e|st|t|x-amz-.*)$'
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, strip_params=DEFAULT_STRIP_PARAMS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.strip_params = re.compile(strip_params)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'keys'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._objects())
+        self.evict() # The cap may have been lowered since the last run
+
+    def _objects(self):
+        return [path for path in glob.glob(os.path.join(self.cache_dir, 'objects', '*')) if not path.endswith('.tmp')]
+
+    def _key_path(self, segment_url, byte_range):
+        parsed = urlparse(segment_url)
+        query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not self.strip_params.match(k)]
+        normalized = parsed._replace(query=urlencode(sorted(query)), fragment='').geturl()
+        if byte_range is not None:
+            normalized += '@{}+{}'.format(*byte_range)
+        return os.path.join(self.cache_dir, 'keys', hashlib.sha256(normalized.encode('utf-8')).hexdigest())
+
+    def _write_atomic(self, path, write):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def lookup(self, segment_url, byte_range=None):
+        """Returns the path of the cached content of a segment, or None, counting the hit or miss."""
+        key_path = self._key_path(segment_url, byte_range)
+        object_path = None
+        try:
+            with open(key_path, 'r', encoding='utf-8') as f:
+                object_path = os.path.join(self.cache_dir, 'objects', f.read().strip())
+            os.utime(object_path) # Most recently used
+        except FileNotFoundError:
+            if object_path is not None:
+                os.remove(key_path) # Its content was evicted
+            object_path = None
+        with self.lock:
+            if object_path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return object_path
+
+    def _add_object(self, object_path, write):
+        """Writes a content object unless it exists, counting its size once even if two workers store it together."""
+        if os.path.exists(object_path):
+            return
+        tmp_path = f"{object_path}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        with self.lock:
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, object_path)
+            self.size += os.path.getsize(object_path)
+
+    def store(self, segment_url, byte_range=None, source_path=None, data=None, digest=None):
+        """Adds a downloaded segment, given as a file or as bytes, and its sha256 if already known. A full disk only costs the cache entry."""
+        try:
+            if digest is None:
+                digest = hashlib.sha256(data).hexdigest() if data is not None else hash_file(source_path).hexdigest()
+            object_path = os.path.join(self.cache_dir, 'objects', digest)
+            if data is not None:
+                def write(path):
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                self._add_object(object_path, write)
+            else:
+                self._add_object(object_path, lambda path: link_or_copy(source_path, path))
+            def write_key(path):
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(digest)
+            self._write_atomic(self._key_path(segment_url, byte_range), write_key)
+        except OSError:
+            return
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used contents until the cache is back under 90% of its cap."""
+        with self.lock:
+            if self.size <= self.max_bytes:
+                return
+            for object_path in sorted(self._objects(), key=os.path.getmtime):
+                if self.size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    size = os.path.getsize(object_path)
+                    os.remove(object_path)
+                except OSError:
+                    continue
+                self.size -= size
+
+def restore_cached_segment(cached_path, segment_url, segment_path, assembler=None, index=None, manifest=None):
+    """Serves a segment from the cache into segment_path or the assembler. Returns False if it was evicted meanwhile."""
+    try:
+        if assembler is not None:
+            with open(cached_path, 'rb') as f:
+                data = f.read()
+            assembler.add(index, data)
+            return True
+        link_or_copy(cached_path, segment_path)
+    except FileNotFoundError:
+        return False
+    if manifest is not None:
+        size = os.path.getsize(segment_path)
+        manifest.record(segment_path, segment_url, size, size, os.path.basename(cached_path), True)
+    return True
 
 # --- Configuration and Language Handling ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -82,147 +1211,1697 @@ def load_language_strings(lang_code):
 
 # parse_star_init_data function is removed as it's no longer needed for binary data
 
-def download_m3u8(url, headers, lang_strings):
+def download_m3u8(url, headers, lang_strings, session_pool=None, log=print):
     """Downloads the M3U8 file."""
-    print(lang_strings["downloading_m3u8"].format(m3u8_url=url))
+    log(lang_strings["downloading_m3u8"].format(m3u8_url=url))
+    http = session_pool or requests
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = http.get(url, headers=headers, timeout=10)
         response.raise_for_status()
-        print(lang_strings["m3u8_download_success"].format(length=len(response.content)))
+        log(lang_strings["m3u8_download_success"].format(length=len(response.content)))
         return response.text
     except requests.exceptions.RequestException as e:
-        print(lang_strings["m3u8_download_failed"].format(error=e))
+        log(lang_strings["m3u8_download_failed"].format(error=e))
         return None
 
-def download_segment(segment_url, headers, segment_path, lang_strings, downloader, max_retries=5):
-    """Downloads a single video segment."""
-    for attempt in range(max_retries):
+def poll_playlist(url, headers, session_pool, validators):
+    """Re-fetches a live playlist with a conditional GET. Returns (content, or None if unchanged, and the new validators)."""
+    request_headers = dict(headers)
+    if validators.get('etag'):
+        request_headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        request_headers['If-Modified-Since'] = validators['last_modified']
+    response = session_pool.get(url, headers=request_headers, timeout=10)
+    if response.status_code == 304:
+        return None, validators
+    response.raise_for_status()
+    return response.text, {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+def expected_segment_length(status_code, response_headers, offset):
+    """Returns the full size of a segment announced by the server, or None if unknown."""
+    if response_headers.get('Content-Encoding', 'identity') != 'identity':
+        return None # Content-Length counts compressed bytes
+    if status_code == 206:
+        total = response_headers.get('Content-Range', '').rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+    length = response_headers.get('Content-Length')
+    if length is None or not length.isdigit():
+        return None
+    return offset + int(length) if status_code == 206 else int(length)
+
+def hash_file(path, verifier=None):
+    """Returns a sha256 object primed with the contents of path, also feeding them to a SegmentVerifier if given."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+            if verifier is not None:
+                verifier.feed(chunk)
+    return checksum
+
+def byte_range_headers(headers, byte_range=None, offset=0):
+    """Returns headers asking for byte_range (start, length) of a resource, skipping its first `offset` bytes."""
+    if byte_range is None and not offset:
+        return headers
+    request_headers = dict(headers)
+    if byte_range is None:
+        request_headers['Range'] = f'bytes={offset}-'
+    else:
+        start, length = byte_range
+        request_headers['Range'] = f'bytes={start + offset}-{start + length - 1}'
+    return request_headers
+
+def range_headers(headers, part_path, byte_range=None):
+    """Returns (request headers, offset), asking for the rest of a partially written .part file."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return byte_range_headers(headers, byte_range, offset), offset
+
+def finish_segment_file(segment_url, segment_path, manifest, expected, written, checksum, verifier=None):
+    """Checks the written size and content and atomically moves the .part file into place. Returns the sha256 hex digest."""
+    part_path = segment_path + '.part'
+    complete = expected is None or written == expected
+    if complete and verifier is not None:
+        verifier.finish()
+    if manifest is not None:
+        manifest.record(segment_path, segment_url, expected, written, checksum.hexdigest(), complete)
+    if not complete:
+        if written > expected:
+            os.remove(part_path) # Cannot be continued, start over
+        raise IncompleteSegmentError(f"{written} of {expected} bytes received")
+    os.replace(part_path, segment_path)
+    return checksum.hexdigest()
+
+def accepts_ranges(response, byte_range=None):
+    """Tells whether the server of a response would serve parts of the body with HTTP Range."""
+    return byte_range is not None or response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+def read_part(response, writer, length, transfer, segment_url):
+    """Copies up to `length` bytes of a response body into writer. Returns the number of bytes copied."""
+    copied = 0
+    for chunk in transfer.iter_body(response, segment_url):
+        chunk = chunk[:length - copied]
+        writer.write(chunk)
+        copied += len(chunk)
+        if copied >= length:
+            break
+    return copied
+
+def fetch_range_parts(http, segment_url, headers, byte_range, response, parts, target, transfer):
+    """Fills target (a bytearray or preallocated file) from parallel HTTP Range requests, one per (offset, length) part.
+
+    The first part is read from the already open response, so only the other parts cost a new request.
+    """
+    base = byte_range[0] if byte_range is not None else 0
+
+    def fetch_part(offset, length):
+        transfer.before_request(segment_url)
+        writer = PartWriter(target, offset)
         try:
-            response = requests.get(segment_url, headers=headers, stream=True, timeout=30)
-            response.raise_for_status()
-            with open(segment_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            with downloader.lock:
-                downloader.completed += 1
-            downloader.print_progress(lang_strings)
+            with http.get(segment_url, headers=byte_range_headers(headers, (base + offset, length)), stream=True, timeout=30) as part:
+                part.raise_for_status()
+                if part.status_code != 206:
+                    raise IncompleteSegmentError("server ignored the byte range")
+                copied = read_part(part, writer, length, transfer, segment_url)
+        finally:
+            writer.close()
+        if copied != length:
+            raise IncompleteSegmentError(f"{copied} of {length} bytes received")
+
+    executor = transfer.part_executor or concurrent.futures.ThreadPoolExecutor(max_workers=len(parts) - 1)
+    futures = [executor.submit(fetch_part, offset, length) for offset, length in parts[1:]]
+    try:
+        offset, length = parts[0]
+        writer = PartWriter(target, offset)
+        try:
+            copied = read_part(response, writer, length, transfer, segment_url)
+        finally:
+            writer.close()
+            response.close() # Frees the connection for the other parts; the rest of the body is not needed
+        if copied != length:
+            raise IncompleteSegmentError(f"{copied} of {length} bytes received")
+        for future in futures:
+            future.result()
+    finally:
+        # The parts write into target, so none may still be running when it is discarded
+        concurrent.futures.wait(futures)
+        if executor is not transfer.part_executor:
+            executor.shutdown()
+
+def fetch_segment_file(http, segment_url, headers, segment_path, manifest=None, byte_range=None, transfer=None, verifier=None):
+    """Streams a segment into segment_path via a .part file, continuing a partial one with HTTP Range.
+
+    Returns (bytes received, sha256 hex digest of the segment).
+    """
+    transfer = transfer or TransferSettings()
+    part_path = segment_path + '.part'
+    request_headers, offset = range_headers(headers, part_path, byte_range)
+    # The context manager releases the connection back to the pool
+    # even if writing the body fails half-way.
+    with http.get(segment_url, headers=request_headers, stream=True, timeout=30) as response:
+        if response.status_code == 416 and offset:
+            # The .part file is not a prefix of this segment (or it was already complete): retry it from the start
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise IncompleteSegmentError("stale .part file discarded")
+        response.raise_for_status()
+        if response.status_code != 206:
+            if byte_range is not None:
+                raise IncompleteSegmentError("server ignored the byte range")
+            offset = 0 # Server ignored the Range request, start over
+        if byte_range is not None:
+            expected = byte_range[1]
+        else:
+            expected = expected_segment_length(response.status_code, response.headers, offset)
+        parts = transfer.split_ranges(expected) if not offset and accepts_ranges(response, byte_range) else None
+        if parts:
+            # Large segment: several connections write their parts at their offsets into a preallocated file
+            with open(part_path, 'wb') as f:
+                preallocate_file(f, expected)
+            try:
+                fetch_range_parts(http, segment_url, headers, byte_range, response, parts, part_path, transfer)
+            except BaseException:
+                os.remove(part_path) # Has holes, so it cannot be continued with Range
+                raise
+            digest = finish_segment_file(segment_url, segment_path, manifest, expected, expected, hash_file(part_path, verifier), verifier)
+            return expected, digest
+        checksum = hash_file(part_path, verifier) if offset else hashlib.sha256()
+        written = offset
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in transfer.iter_body(response, segment_url):
+                # Verified while streaming, so a bad body is caught without a second pass over the file
+                if verifier is not None:
+                    verifier.feed(chunk)
+                f.write(chunk)
+                checksum.update(chunk)
+                written += len(chunk)
+    digest = finish_segment_file(segment_url, segment_path, manifest, expected, written, checksum, verifier)
+    return written - offset, digest
+
+def discard_invalid_segment(downloader, segment_path):
+    """Counts a segment rejected by verification and drops its .part file, so the retry starts from scratch."""
+    with downloader.lock:
+        downloader.invalid += 1
+    part_path = segment_path + '.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+def record_failed_segment(downloader, assembler=None, index=None):
+    """Counts a segment that will not be retried and lets the assembler move past it."""
+    with downloader.lock:
+        downloader.failed += 1
+    if assembler is not None:
+        assembler.skip(index)
+
+def download_segment(segment_url, headers, segment_path, lang_strings, downloader, retry_policy=None, session_pool=None, assembler=None, index=None, manifest=None, controller=None, byte_range=None, duration=0.0, transfer=None, cache=None, verify=None):
+    """Downloads a single video segment (or byte_range of it), to segment_path or into the assembler if one is given.
+
+    verify, if given, returns a fresh SegmentVerifier for each attempt; a segment that fails verification is retried.
+    """
+    http = session_pool or requests
+    retry_policy = retry_policy or RetryPolicy()
+    transfer = transfer or TransferSettings()
+    if manifest is not None and manifest.is_complete(segment_path, segment_url):
+        downloader.mark_completed(duration)
+        return True
+    if cache is not None:
+        cached_path = cache.lookup(segment_url, byte_range)
+        if cached_path and restore_cached_segment(cached_path, segment_url, segment_path, assembler, index, manifest):
+            downloader.mark_completed(duration)
             return True
-        except requests.exceptions.RequestException as e:
-            with downloader.lock:
-                downloader.failed += 1
-            time.sleep(2 ** attempt)
+    for attempt in range(retry_policy.max_retries):
+        wait = retry_policy.before_attempt(segment_url)
+        if wait:
+            time.sleep(wait)
+        transfer.before_request(segment_url)
+        request_headers, generation = header_snapshot(headers)
+        if controller is not None:
+            controller.acquire()
+        try:
+            started = time.time()
+            verifier = verify() if verify is not None else None
+            if assembler is not None:
+                with http.get(segment_url, headers=byte_range_headers(request_headers, byte_range), stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if byte_range is not None and response.status_code != 206:
+                        raise IncompleteSegmentError("server ignored the byte range")
+                    size = byte_range[1] if byte_range is not None else expected_segment_length(response.status_code, response.headers, 0)
+                    parts = transfer.split_ranges(size) if accepts_ranges(response, byte_range) else None
+                    if parts:
+                        data = bytearray(size)
+                        fetch_range_parts(http, segment_url, request_headers, byte_range, response, parts, data, transfer)
+                    else:
+                        data = b''.join(transfer.iter_body(response, segment_url))
+                if size is not None and len(data) != size:
+                    raise IncompleteSegmentError(f"{len(data)} of {size} bytes received")
+                if verifier is not None:
+                    verify_segment_data(data, verifier)
+                if cache is not None:
+                    cache.store(segment_url, byte_range, data=data)
+                assembler.add(index, data)
+                received = len(data)
+            else:
+                received, digest = fetch_segment_file(http, segment_url, request_headers, segment_path, manifest, byte_range, transfer, verifier)
+                if cache is not None:
+                    cache.store(segment_url, byte_range, source_path=segment_path, digest=digest)
+            latency = time.time() - started
+            if controller is not None:
+                controller.record_success(received, latency)
+            retry_policy.record_success(segment_url)
+            downloader.record_transfer(segment_url, received, latency)
+            downloader.mark_completed(duration)
+            return True
+        except (requests.exceptions.RequestException, IncompleteSegmentError) as e:
+            if isinstance(e, InvalidSegmentError):
+                discard_invalid_segment(downloader, segment_path)
+            if refresh_expired_headers(headers, e, generation):
+                delay = 0.0 # Retry at once with the renewed headers
+            else:
+                kind = RetryPolicy.classify(e)
+                # Only overload slows the workers down; a 404 or a corrupt body is not fixed by fewer of them
+                if controller is not None and kind in CONGESTION_ERRORS:
+                    controller.record_error(throttled=kind == 'throttled')
+                delay = retry_policy.next_delay(segment_url, e, attempt)
+        except OSError:
+            # A local file error (disk full, no permission) is not retried, but still counts as a failed segment
+            record_failed_segment(downloader, assembler, index)
+            raise
+        finally:
+            if controller is not None:
+                controller.release()
+        if delay is None:
+            break
+        with downloader.lock:
+            downloader.retries += 1
+        # Back off without holding a download slot
+        time.sleep(delay)
+    record_failed_segment(downloader, assembler, index)
     return False
 
-def parse_m3u8(m3u8_content, lang_strings):
-    """Parses M3U8 content to extract segments and init.mp4."""
-    segments = []
-    star_init_data = None
-    init_segment_url = None
-    
-    # Extract STAR-INIT-DATA from #EXT-X-MAP tag
-    map_match = re.search(r'#EXT-X-MAP:URI="([^"]+?\.mp4)"(?:,BYTERANGE="([^"]+?)")?(?:,STAR-INIT-DATA="([^"]+?)")?', m3u8_content)
-    if map_match:
-        init_segment_url = map_match.group(1)
-        if map_match.group(3):
-            star_init_data = map_match.group(3)
-            print(lang_strings["star_init_data_found_map"].format(data=star_init_data[:50]))
-
-    # If not in EXT-X-MAP, check general STAR-INIT-DATA tag
-    if not star_init_data:
-        star_init_data_match = re.search(r'#STAR-INIT-DATA:([^\n]+)', m3u8_content)
-        if star_init_data_match:
-            star_init_data = star_init_data_match.group(1).strip()
-            print(lang_strings["star_init_data_found"].format(data=star_init_data[:50]))
-    
-    if not star_init_data:
-        print(lang_strings["star_init_data_not_found"])
+def download_segments_threaded(jobs, headers, lang_strings, session_pool, max_workers, controller=None, retry_policy=None, transfer=None):
+    """Downloads SegmentJobs on a pool of blocking worker threads, starting them in the order given."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_job = {}
+        for job in jobs:
+            future = submit_segment_job(executor, job, headers, lang_strings, session_pool, controller, retry_policy, transfer)
+            future_to_job[future] = job
+        report_segment_results(future_to_job, lang_strings)
+
+def submit_segment_job(executor, job, headers, lang_strings, session_pool, controller=None, retry_policy=None, transfer=None):
+    """Queues one SegmentJob on a thread pool and returns its future."""
+    return executor.submit(
+        download_segment, 
+        job.url, 
+        headers, 
+        job.path,
+        lang_strings, 
+        job.title.downloader,
+        retry_policy=retry_policy,
+        session_pool=session_pool,
+        assembler=job.title.assembler,
+        index=job.index,
+        manifest=job.title.manifest,
+        controller=controller,
+        byte_range=job.byte_range,
+        duration=job.duration,
+        transfer=transfer,
+        cache=job.title.cache,
+        verify=job.verify
+    )
+
+def report_segment_results(future_to_job, lang_strings):
+    """Waits for segment futures and prints the ones that failed."""
+    for future in concurrent.futures.as_completed(future_to_job):
+        job = future_to_job[future]
+        try:
+            success = future.result()
+            if not success:
+                job.title.log(lang_strings["segment_download_failed_summary"].format(url=job.url))
+        except Exception as exc:
+            job.title.log(lang_strings["segment_download_exception"].format(url=job.url, error=exc))
+
+async def iter_body_async(response, segment_url, transfer):
+    """Yields the chunks of an aiohttp response body, paced by the rate limiter."""
+    async for chunk in response.content.iter_chunked(transfer.read_size(segment_url)):
+        if transfer.limiter is not None:
+            delay = transfer.limiter.transfer_delay(segment_url, len(chunk))
+            if delay:
+                await asyncio.sleep(delay)
+        yield chunk
+
+async def fetch_segment_file_async(session, segment_url, headers, segment_path, manifest=None, byte_range=None, transfer=None, verifier=None):
+    """Asyncio counterpart of fetch_segment_file."""
+    transfer = transfer or TransferSettings()
+    part_path = segment_path + '.part'
+    request_headers, offset = range_headers(headers, part_path, byte_range)
+    async with session.get(segment_url, headers=request_headers) as response:
+        if response.status == 416 and offset:
+            # The .part file is not a prefix of this segment (or it was already complete): retry it from the start
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise IncompleteSegmentError("stale .part file discarded")
+        response.raise_for_status()
+        if response.status != 206:
+            if byte_range is not None:
+                raise IncompleteSegmentError("server ignored the byte range")
+            offset = 0 # Server ignored the Range request, start over
+        if byte_range is not None:
+            expected = byte_range[1]
+        else:
+            expected = expected_segment_length(response.status, response.headers, offset)
+        checksum = hash_file(part_path, verifier) if offset else hashlib.sha256()
+        written = offset
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            async for chunk in iter_body_async(response, segment_url, transfer):
+                if verifier is not None:
+                    verifier.feed(chunk)
+                f.write(chunk)
+                checksum.update(chunk)
+                written += len(chunk)
+    digest = finish_segment_file(segment_url, segment_path, manifest, expected, written, checksum, verifier)
+    return written - offset, digest
+
+async def download_segment_async(session, semaphore, segment_url, headers, segment_path, lang_strings, downloader, retry_policy, assembler=None, index=None, manifest=None, byte_range=None, duration=0.0, transfer=None, cache=None, verify=None):
+    """Downloads a single video segment on the asyncio engine, with the same retries and verification as download_segment."""
+    transfer = transfer or TransferSettings()
+    if manifest is not None and manifest.is_complete(segment_path, segment_url):
+        downloader.mark_completed(duration)
+        return True
+    if cache is not None:
+        cached_path = cache.lookup(segment_url, byte_range)
+        if cached_path and restore_cached_segment(cached_path, segment_url, segment_path, assembler, index, manifest):
+            downloader.mark_completed(duration)
+            return True
+    for attempt in range(retry_policy.max_retries):
+        wait = retry_policy.before_attempt(segment_url)
+        if wait:
+            await asyncio.sleep(wait)
+        if transfer.limiter is not None:
+            delay = transfer.limiter.request_delay(segment_url)
+            if delay:
+                await asyncio.sleep(delay)
+        # aiohttp manages keep-alive itself
+        request_headers, generation = header_snapshot(headers, exclude=('connection',))
+        # Only the request holds one of the `concurrency` slots, not the backoff between attempts
+        await semaphore.acquire()
+        try:
+            started = time.time()
+            verifier = verify() if verify is not None else None
+            if assembler is not None:
+                async with session.get(segment_url, headers=byte_range_headers(request_headers, byte_range)) as response:
+                    response.raise_for_status()
+                    if byte_range is not None and response.status != 206:
+                        raise IncompleteSegmentError("server ignored the byte range")
+                    data = b''.join([chunk async for chunk in iter_body_async(response, segment_url, transfer)])
+                if verifier is not None:
+                    verify_segment_data(data, verifier)
+                if cache is not None:
+                    cache.store(segment_url, byte_range, data=data)
+                assembler.add(index, data)
+                received = len(data)
+            else:
+                received, digest = await fetch_segment_file_async(session, segment_url, request_headers, segment_path, manifest, byte_range, transfer, verifier)
+                if cache is not None:
+                    cache.store(segment_url, byte_range, source_path=segment_path, digest=digest)
+            retry_policy.record_success(segment_url)
+            downloader.record_transfer(segment_url, received, time.time() - started)
+            downloader.mark_completed(duration)
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteSegmentError) as e:
+            if isinstance(e, InvalidSegmentError):
+                discard_invalid_segment(downloader, segment_path)
+            # A refresh blocks the event loop, which pauses every download until the new headers are in place
+            if refresh_expired_headers(headers, e, generation):
+                delay = 0.0
+            else:
+                delay = retry_policy.next_delay(segment_url, e, attempt)
+        except OSError:
+            # A local file error (disk full, no permission) is not retried, but still counts as a failed segment
+            record_failed_segment(downloader, assembler, index)
+            raise
+        finally:
+            semaphore.release()
+        if delay is None:
+            break
+        with downloader.lock:
+            downloader.retries += 1
+        await asyncio.sleep(delay)
+    record_failed_segment(downloader, assembler, index)
+    return False
+
+def download_segments_async(jobs, headers, lang_strings, concurrency, retry_policy=None, transfer=None):
+    """Downloads SegmentJobs with up to `concurrency` requests in flight on one thread."""
+    load_aiohttp()
+    retry_policy = retry_policy or RetryPolicy()
+    transfer = transfer or TransferSettings()
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(
+                *(download_segment_async(session, semaphore, job.url, headers, job.path, lang_strings, job.title.downloader,
+                                         retry_policy, assembler=job.title.assembler, index=job.index, manifest=job.title.manifest,
+                                         byte_range=job.byte_range, duration=job.duration, transfer=transfer,
+                                         cache=job.title.cache, verify=job.verify)
+                  for job in jobs),
+                return_exceptions=True
+            )
+
+    results = asyncio.run(run())
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            job.title.log(lang_strings["segment_download_exception"].format(url=job.url, error=result))
+        elif not result:
+            job.title.log(lang_strings["segment_download_failed_summary"].format(url=job.url))
 
-    # Extract segment URLs
+def parse_attribute_list(text):
+    """Parses an M3U8 attribute list such as 'BANDWIDTH=800000,RESOLUTION=1280x720,CODECS="a,b"'."""
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+def is_master_playlist(m3u8_content):
+    return '#EXT-X-STREAM-INF' in m3u8_content
+
+def parse_master_playlist(m3u8_content, base_url):
+    """Returns the variants of a master playlist as dicts with url, bandwidth, width and height."""
+    variants = []
+    stream_inf = None
     for line in m3u8_content.splitlines():
-        if line and not line.startswith('#'):
-            segments.append(line.strip())
-            
-    if not segments:
-        print(lang_strings["no_segments_found"])
-        return None, None, None
-    
-    print(lang_strings["segments_found"].format(count=len(segments)))
-    return init_segment_url, segments, star_init_data
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = parse_attribute_list(line.split(':', 1)[1])
+        elif line and not line.startswith('#') and stream_inf is not None:
+            width, _, height = stream_inf.get('RESOLUTION', '').partition('x')
+            variants.append({
+                'url': urljoin(base_url, line),
+                'bandwidth': int(stream_inf.get('BANDWIDTH') or 0),
+                'width': int(width) if width.isdigit() else 0,
+                'height': int(height) if height.isdigit() else 0
+            })
+            stream_inf = None
+    # Highest quality first
+    variants.sort(key=lambda v: (v['bandwidth'], v['height']), reverse=True)
+    return variants
 
-def combine_segments_py_binary(segments_dir, output_file, lang_strings):
-    """Combines downloaded video segments using pure Python binary concatenation."""
-    
-    print(lang_strings["combining_segments"])
-    
-    # Get all downloaded segment files
-    all_segment_files = glob.glob(os.path.join(segments_dir, "*"))
+def variant_syntax_error(preference):
+    """Returns why a --variant value cannot be used, or None if it is valid."""
+    preference = (preference or 'best').strip().lower()
+    if preference.startswith('<=') and not preference[2:].strip().isdigit():
+        return f"invalid --variant '{preference}': a bandwidth cap needs bits/s, e.g. <=2000000"
+    return None
+
+def select_variant(variants, preference='best'):
+    """Picks a variant: 'best', 'worst', a resolution ('720p', '1280x720') or a bandwidth cap in bits/s ('<=2000000')."""
+    preference = (preference or 'best').strip().lower()
+    if preference == 'worst':
+        return variants[-1]
+    if preference.startswith('<='):
+        cap = int(preference[2:].strip())
+        fitting = [v for v in variants if v['bandwidth'] <= cap]
+        return fitting[0] if fitting else variants[-1]
+    if preference.endswith('p') and preference[:-1].isdigit():
+        height = int(preference[:-1])
+        # Closest height, preferring the higher bandwidth on ties
+        return min(variants, key=lambda v: abs(v['height'] - height))
+    if 'x' in preference:
+        width, _, height = preference.partition('x')
+        if width.isdigit() and height.isdigit():
+            return min(variants, key=lambda v: abs(v['width'] - int(width)) + abs(v['height'] - int(height)))
+    return variants[0]
+
+def probe_throughput(segment_urls, headers, session_pool):
+    """Downloads the given segments in parallel and returns the combined throughput in bytes/s, or None."""
+    def fetch(url):
+        with session_pool.get(url, headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            return sum(len(chunk) for chunk in response.iter_content(chunk_size=65536))
+
+    start_time = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segment_urls)) as executor:
+            received = sum(executor.map(fetch, segment_urls))
+    except requests.exceptions.RequestException:
+        return None
+    return received / max(time.time() - start_time, 1e-6)
+
+def probe_variant(variants, headers, lang_strings, session_pool, target_seconds, probe_segments=3, log=print):
+    """Picks the highest variant whose whole download should finish within target_seconds at the probed throughput."""
+    # Probe with the largest variant: its segments give the most accurate reading of the link
+    top_url = variants[0]['url']
+    m3u8_content = download_m3u8(top_url, headers, lang_strings, session_pool, log)
+    if not m3u8_content:
+        return variants[-1]
+    playlist = parse_media_playlist(m3u8_content)
+    segments = playlist.segments
+    segment_urls = [urljoin(top_url, segments.uri(i)) for i in range(min(probe_segments, len(segments)))]
+    duration = segments.total_duration()
+    throughput = probe_throughput(segment_urls, headers, session_pool) if segment_urls else None
+    if not throughput or not duration:
+        return variants[-1]
+    log(lang_strings["variant_probe_result"].format(rate=throughput / (1024 * 1024), minutes=duration / 60))
+    for variant in variants:
+        # BANDWIDTH is in bits per second of playback
+        needed_seconds = variant['bandwidth'] / 8 * duration / throughput
+        if needed_seconds <= target_seconds:
+            return variant
+    return variants[-1]
+
+class SegmentTable:
+    """Column-oriented table of the media segments of a playlist; a URI shared by byte-range segments is stored once."""
+    __slots__ = ('uris', 'uri_ids', 'durations', 'range_starts', 'range_lengths', 'sequences',
+                 'discontinuities', 'key_ids', '_uri_lookup')
+
+    def __init__(self):
+        self.uris = []
+        self._uri_lookup = {}
+        self.uri_ids = array('l')
+        self.durations = array('d')
+        self.range_starts = array('q')  # -1 when the segment is a whole resource
+        self.range_lengths = array('q')
+        self.sequences = array('q')
+        self.discontinuities = bytearray()
+        self.key_ids = array('l')       # Index into MediaPlaylist.keys, -1 when unencrypted
+
+    def append(self, uri, duration, byte_range, sequence, discontinuity, key_id):
+        uri_id = self._uri_lookup.get(uri)
+        if uri_id is None:
+            uri_id = self._uri_lookup[uri] = len(self.uris)
+            self.uris.append(uri)
+        self.uri_ids.append(uri_id)
+        self.durations.append(duration)
+        self.range_starts.append(byte_range[0] if byte_range else -1)
+        self.range_lengths.append(byte_range[1] if byte_range else -1)
+        self.sequences.append(sequence)
+        self.discontinuities.append(1 if discontinuity else 0)
+        self.key_ids.append(key_id)
+
+    def __len__(self):
+        return len(self.uri_ids)
+
+    def uri(self, i):
+        return self.uris[self.uri_ids[i]]
+
+    def byte_range(self, i):
+        """Returns (start, length) of segment i, or None if it is a whole resource."""
+        if self.range_starts[i] < 0:
+            return None
+        return self.range_starts[i], self.range_lengths[i]
+
+    def total_duration(self):
+        return sum(self.durations)
+
+class MediaPlaylist:
+    """Playlist-level tags of a media playlist plus its SegmentTable."""
+    __slots__ = ('version', 'target_duration', 'media_sequence', 'playlist_type', 'endlist',
+                 'map_uri', 'map_byterange', 'star_init_data', 'keys', 'segments')
+
+    def __init__(self):
+        self.version = None
+        self.target_duration = None
+        self.media_sequence = 0
+        self.playlist_type = None
+        self.endlist = False
+        self.map_uri = None
+        self.map_byterange = None
+        self.star_init_data = None
+        self.keys = []  # Attribute dicts of the #EXT-X-KEY tags in effect
+        self.segments = SegmentTable()
+
+def parse_byterange(value):
+    """Parses '<length>[@<offset>]' into (start, length); start is None when the range follows the previous one."""
+    length, _, offset = value.strip().strip('"').partition('@')
+    return (int(offset) if offset else None), int(length)
+
+class M3U8Parser:
+    """Incremental media playlist parser, fed one line at a time."""
+    def __init__(self):
+        self.playlist = MediaPlaylist()
+        self.sequence = None
+        self.duration = 0.0
+        self.byte_range = None
+        self.discontinuity = False
+        self.key_id = -1
+        self.range_ends = {}  # URI -> end of its last byte range
+
+    def feed(self, line):
+        line = line.strip()
+        if not line:
+            return
+        playlist = self.playlist
+        if not line.startswith('#'):
+            if self.sequence is None:
+                self.sequence = playlist.media_sequence
+            byte_range = self.byte_range
+            if byte_range and byte_range[0] is None:
+                byte_range = (self.range_ends.get(line, 0), byte_range[1])
+            if byte_range:
+                self.range_ends[line] = byte_range[0] + byte_range[1]
+            playlist.segments.append(line, self.duration, byte_range, self.sequence, self.discontinuity, self.key_id)
+            self.sequence += 1
+            self.duration = 0.0
+            self.byte_range = None
+            self.discontinuity = False
+            return
+        tag, _, value = line.partition(':')
+        if tag == '#EXTINF':
+            duration = value.split(',', 1)[0]
+            try:
+                self.duration = float(duration)
+            except ValueError:
+                self.duration = 0.0
+        elif tag == '#EXT-X-BYTERANGE':
+            self.byte_range = parse_byterange(value)
+        elif tag == '#EXT-X-DISCONTINUITY':
+            self.discontinuity = True
+        elif tag == '#EXT-X-MEDIA-SEQUENCE':
+            playlist.media_sequence = int(value)
+        elif tag == '#EXT-X-TARGETDURATION':
+            playlist.target_duration = float(value)
+        elif tag == '#EXT-X-VERSION':
+            playlist.version = int(value)
+        elif tag == '#EXT-X-PLAYLIST-TYPE':
+            playlist.playlist_type = value
+        elif tag == '#EXT-X-ENDLIST':
+            playlist.endlist = True
+        elif tag == '#EXT-X-KEY':
+            attributes = parse_attribute_list(value)
+            if attributes.get('METHOD', 'NONE') == 'NONE':
+                self.key_id = -1
+            else:
+                playlist.keys.append(attributes)
+                self.key_id = len(playlist.keys) - 1
+        elif tag == '#EXT-X-MAP' and playlist.map_uri is None:
+            attributes = parse_attribute_list(value)
+            playlist.map_uri = attributes.get('URI')
+            if attributes.get('BYTERANGE'):
+                start, length = parse_byterange(attributes['BYTERANGE'])
+                playlist.map_byterange = (start or 0, length)
+            if attributes.get('STAR-INIT-DATA'):
+                playlist.star_init_data = attributes['STAR-INIT-DATA']
+        elif tag == '#STAR-INIT-DATA' and not playlist.star_init_data:
+            playlist.star_init_data = value.strip()
+
+    def close(self):
+        return self.playlist
+
+def parse_media_playlist(m3u8_content):
+    """Parses a media playlist without splitting it into a list of lines first."""
+    parser = M3U8Parser()
+    for line in io.StringIO(m3u8_content):
+        parser.feed(line)
+    return parser.close()
+
+def parse_m3u8(m3u8_content, lang_strings, log=print):
+    """Parses M3U8 content into a MediaPlaylist. Returns None if the playlist has no segments and no init data."""
+    playlist = parse_media_playlist(m3u8_content)
+    star_init_data = playlist.star_init_data
     
-    # Separate init.mp4 if it exists
-    init_mp4_path = os.path.join(segments_dir, "init.mp4")
-    has_init_mp4 = os.path.exists(init_mp4_path)
+    if star_init_data and playlist.map_uri:
+        log(lang_strings["star_init_data_found_map"].format(data=star_init_data[:50]))
+    elif star_init_data:
+        log(lang_strings["star_init_data_found"].format(data=star_init_data[:50]))
+    else:
+        log(lang_strings["star_init_data_not_found"])
+
+    if not playlist.segments:
+        log(lang_strings["no_segments_found"])
+        if not star_init_data and not playlist.map_uri:
+            return None
+        return playlist
     
-    # Filter out init.mp4 from the general list of segments
-    segment_files_to_sort = [f for f in all_segment_files if os.path.isfile(f) and f != init_mp4_path]
+    log(lang_strings["segments_found"].format(count=len(playlist.segments)))
+    return playlist
 
-    def natural_sort_key(s):
-        return [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', os.path.basename(s))]
+COPY_CHUNK_SIZE = 1024 * 1024 # Buffer size when the kernel cannot copy file-to-file
+
+def preallocate_file(outfile, size):
+    """Reserves `size` bytes for outfile up front so the merge does not fragment the disk."""
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(outfile.fileno(), 0, size)
+        else:
+            outfile.truncate(size)
+    except OSError:
+        pass # Preallocation is only an optimization
+
+def append_file(outfile, segment_path):
+    """Appends segment_path to outfile without reading it into Python memory."""
+    # Both files are unbuffered so the kernel copy and the fallback share file positions.
+    with open(segment_path, 'rb', buffering=0) as infile:
+        remaining = os.fstat(infile.fileno()).st_size
+        try:
+            while remaining > 0:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(infile.fileno(), outfile.fileno(), remaining)
+                else:
+                    copied = os.sendfile(outfile.fileno(), infile.fileno(), None, remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (OSError, AttributeError):
+            # No file-to-file kernel copy here (e.g. Windows, macOS, some filesystems):
+            # continue from the current position with a chunked buffered copy.
+            shutil.copyfileobj(infile, outfile, COPY_CHUNK_SIZE)
 
-    # Sort the remaining segments numerically
-    sorted_other_segments = sorted(segment_files_to_sort, key=natural_sort_key)
+def combine_segments_py_binary(segments_dir, output_file, lang_strings, header=None, segment_files=None, log=print):
+    """Combines downloaded video segments using pure Python binary concatenation.
+
+    header (the init segment) is written first if given; segment_files, if given, are the segments in order,
+    otherwise every finished segment in segments_dir is combined in natural order after init.mp4.
+    """
     
-    # Prepend init.mp4 if it exists
-    final_ordered_segments = []
-    if has_init_mp4:
-        final_ordered_segments.append(init_mp4_path)
+    log(lang_strings["combining_segments"])
     
-    final_ordered_segments.extend(sorted_other_segments)
+    final_ordered_segments = []
+    if segment_files is not None:
+        # Segments that failed to download are left out, as in a directory listing
+        final_ordered_segments = [f for f in segment_files if os.path.isfile(f)]
+    else:
+        # Get all downloaded segment files
+        all_segment_files = glob.glob(os.path.join(segments_dir, "*"))
+
+        # Separate init.mp4 if it exists
+        init_mp4_path = os.path.join(segments_dir, "init.mp4")
+        has_init_mp4 = os.path.exists(init_mp4_path) and header is None
+
+        # Filter out init.mp4, the resume manifest and unfinished .part files from the general list of segments
+        manifest_path = os.path.join(segments_dir, SegmentManifest.FILE_NAME)
+        segment_files_to_sort = [f for f in all_segment_files
+                                 if os.path.isfile(f) and f not in (init_mp4_path, manifest_path) and not f.endswith('.part')]
+
+        def natural_sort_key(s):
+            return [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', os.path.basename(s))]
 
-    if not final_ordered_segments:
-        print(lang_strings["no_segments_to_combine"])
+        # Prepend init.mp4 if it exists, then the remaining segments sorted numerically
+        if has_init_mp4:
+            final_ordered_segments.append(init_mp4_path)
+        final_ordered_segments.extend(sorted(segment_files_to_sort, key=natural_sort_key))
+
+    if not final_ordered_segments and not header:
+        log(lang_strings["no_segments_to_combine"])
         return False
 
     try:
-        with open(output_file, 'wb') as outfile:
+        start_time = time.time()
+        total_size = len(header or b'') + sum(os.path.getsize(f) for f in final_ordered_segments)
+        with open(output_file, 'wb', buffering=0) as outfile:
+            preallocate_file(outfile, total_size)
+            if header:
+                outfile.write(header)
             for segment_path in final_ordered_segments:
-                with open(segment_path, 'rb') as infile:
-                    outfile.write(infile.read())
-        print(lang_strings["combine_success"])
+                append_file(outfile, segment_path)
+            # Drop any preallocated tail if a segment changed size while merging
+            outfile.truncate(outfile.tell())
+        elapsed = max(time.time() - start_time, 1e-6)
+        mb = total_size / (1024 * 1024)
+        log(lang_strings["combine_success"])
+        log(lang_strings["combine_throughput"].format(mb=mb, seconds=elapsed, rate=mb / elapsed))
         return True
     except IOError as e:
-        print(lang_strings["combine_failed_py_binary"].format(error=e))
-        print(lang_strings["suggestions_header"])
-        print(lang_strings["file_access_issue_suggestion"])
+        log(lang_strings["combine_failed_py_binary"].format(error=e))
+        log(lang_strings["suggestions_header"])
+        log(lang_strings["file_access_issue_suggestion"])
         return False
     except Exception as e:
-        print(lang_strings["combine_failed_py_binary_generic"].format(error=e))
+        log(lang_strings["combine_failed_py_binary_generic"].format(error=e))
         return False
 
 
-def cleanup_files(lang_strings):
+def cleanup_files(lang_strings, downloads_dir=None, log=print):
     """Cleans up intermediate files and directories."""
-    print(lang_strings["starting_cleanup"])
+    log(lang_strings["starting_cleanup"])
     deleted_count = 0
 
-    downloads_dir = os.path.join(SCRIPT_DIR, "downloads")
+    downloads_dir = downloads_dir or os.path.join(SCRIPT_DIR, "downloads")
     if os.path.exists(downloads_dir):
         try:
             shutil.rmtree(downloads_dir)
-            print(lang_strings["deleted_directory"].format(directory=downloads_dir))
+            log(lang_strings["deleted_directory"].format(directory=downloads_dir))
             deleted_count += 1
         except OSError as e:
-            print(lang_strings["delete_directory_failed"].format(directory=downloads_dir, error=e))
+            log(lang_strings["delete_directory_failed"].format(directory=downloads_dir, error=e))
     
-    print(lang_strings["cleanup_complete"].format(deleted=deleted_count))
+    log(lang_strings["cleanup_complete"].format(deleted=deleted_count))
+
+# --- Title Pipeline ---
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Linux; Android 14) StarTimesON/6.16.5-1',
+    'Accept': '*/*',
+    'Range': 'bytes=0-',
+    'Connection': 'keep-alive',
+    'Icy-MetaData': '1',
+    'Accept-Encoding': 'gzip',
+    'Content-Type': 'text/plain',
+    'X-UserID': '123456789',
+    'X-DeviceID': 'abcdefghijklmnopqrstyvwxyzabcdef_android',
+    'X-EventID': 'VOD-mynameis-1145-1419-1910-muyuegithub1',
+    'X-PlayID': 'adbcdefg-1a2b-1145-3c4d-114514191910'
+}
+
+STAR_INIT_CHUNK_SIZE = 64 * 1024 # Base64 characters decoded per step; a multiple of 4
+
+class InitSegment:
+    """The fMP4 init segment of a playlist, held in memory and written ahead of its media segments."""
+    def __init__(self, data, source):
+        self.data = data
+        self.source = source # 'STAR-INIT-DATA' or the #EXT-X-MAP URL
+        self.track_ids = init_track_ids(data)
+
+# Init segments already loaded by this process, keyed by their STAR-INIT-DATA digest or
+# #EXT-X-MAP URL, so titles of a batch that share one (e.g. episodes of a series) load it once
+INIT_SEGMENTS = {}
+INIT_SEGMENTS_LOCK = threading.Lock()
+
+def decode_star_init_data(star_init_data):
+    """Decodes base64, zlib-compressed STAR-INIT-DATA step by step, without a full compressed copy in memory."""
+    decompressor = zlib.decompressobj()
+    parts = []
+    for start in range(0, len(star_init_data), STAR_INIT_CHUNK_SIZE):
+        parts.append(decompressor.decompress(base64.b64decode(star_init_data[start:start + STAR_INIT_CHUNK_SIZE])))
+    parts.append(decompressor.flush())
+    if not decompressor.eof:
+        raise zlib.error("STAR-INIT-DATA is truncated")
+    return b''.join(parts)
+
+def fetch_init_segment(init_url, byte_range, headers, session_pool, retry_policy=None):
+    """Fetches an #EXT-X-MAP init segment into memory before any media segment is queued. Returns its bytes, or None."""
+    retry_policy = retry_policy or RetryPolicy()
+    for attempt in range(retry_policy.max_retries):
+        wait = retry_policy.before_attempt(init_url)
+        if wait:
+            time.sleep(wait)
+        request_headers, generation = header_snapshot(headers)
+        try:
+            with session_pool.get(init_url, headers=byte_range_headers(request_headers, byte_range), timeout=30) as response:
+                response.raise_for_status()
+                if byte_range is not None and response.status_code != 206:
+                    raise IncompleteSegmentError("server ignored the byte range")
+                data = response.content
+            if byte_range is not None and len(data) != byte_range[1]:
+                raise IncompleteSegmentError(f"{len(data)} of {byte_range[1]} bytes received")
+            retry_policy.record_success(init_url)
+            return data
+        except (requests.exceptions.RequestException, IncompleteSegmentError) as e:
+            if refresh_expired_headers(headers, e, generation):
+                delay = 0.0 # Retry at once with the renewed headers
+            else:
+                delay = retry_policy.next_delay(init_url, e, attempt)
+        if delay is None:
+            break
+        time.sleep(delay)
+    return None
+
+def load_init_segment(title, playlist, headers, lang_strings, session_pool):
+    """Returns the InitSegment of a playlist, or None if it has none or it could not be loaded.
+
+    It is saved as init.mp4 in the downloads directory too, which --resume reuses instead of fetching it again.
+    """
+    init_path = os.path.join(title.downloads_dir, "init.mp4")
+    init_segment = None
+    if playlist.star_init_data:
+        key = 'STAR-INIT-DATA:' + hashlib.sha256(playlist.star_init_data.encode()).hexdigest()
+        with INIT_SEGMENTS_LOCK:
+            init_segment = INIT_SEGMENTS.get(key)
+        if init_segment is None:
+            try:
+                init_segment = InitSegment(decode_star_init_data(playlist.star_init_data), 'STAR-INIT-DATA')
+            except (binascii.Error, ValueError, zlib.error) as e:
+                title.log(lang_strings["failed_to_save_star_init_data"].format(error=e))
+        else:
+            title.log(lang_strings["init_segment_reused"].format(size=len(init_segment.data)))
+        if init_segment is not None:
+            with open(init_path, 'wb') as f:
+                f.write(init_segment.data)
+            title.log(lang_strings["star_init_data_saved_as_init_mp4"].format(path=init_path))
+            if playlist.map_uri:
+                # The #EXT-X-MAP segment holds the same content, so it is not fetched
+                title.log(lang_strings["removed_redundant_init_segment_url"])
+    if init_segment is None and playlist.map_uri:
+        init_url = urljoin(title.m3u8_url, playlist.map_uri)
+        key = (strip_query(init_url), playlist.map_byterange)
+        with INIT_SEGMENTS_LOCK:
+            init_segment = INIT_SEGMENTS.get(key)
+        if init_segment is not None:
+            title.log(lang_strings["init_segment_reused"].format(size=len(init_segment.data)))
+            with open(init_path, 'wb') as f:
+                f.write(init_segment.data)
+        elif title.manifest is not None and title.manifest.is_complete(init_path, init_url):
+            with open(init_path, 'rb') as f:
+                init_segment = InitSegment(f.read(), init_url)
+            title.log(lang_strings["init_segment_reused"].format(size=len(init_segment.data)))
+        else:
+            data = fetch_init_segment(init_url, playlist.map_byterange, headers, session_pool)
+            if data is None:
+                title.log(lang_strings["init_segment_failed"].format(url=init_url))
+                return None
+            init_segment = InitSegment(data, init_url)
+            with open(init_path, 'wb') as f:
+                f.write(data)
+            if title.manifest is not None:
+                title.manifest.record(init_path, init_url, len(data), len(data), hashlib.sha256(data).hexdigest(), True)
+            title.log(lang_strings["init_segment_fetched"].format(url=init_url, size=len(data)))
+    if init_segment is not None:
+        with INIT_SEGMENTS_LOCK:
+            INIT_SEGMENTS[key] = init_segment
+    return init_segment
+
+class TitleDownload:
+    """One playlist being downloaded: where its segments and output go, and its progress."""
+    def __init__(self, m3u8_url, output_file, downloads_dir, cache=None, log=print):
+        self.m3u8_url = m3u8_url
+        self.output_file = output_file
+        self.downloads_dir = downloads_dir
+        self.cache = cache # Optional SegmentCache shared by all titles
+        self.log = log # Prints the messages about this title; a no-op for a quiet DownloadJob
+        self.verify = None # Returns a SegmentVerifier for each segment download, unless --no-verify
+        self.downloader = None
+        self.assembler = None
+        self.manifest = None
+        self.init_segment = None # InitSegment written ahead of the media segments, if the playlist has one
+        self.jobs = []
+        # Live/event playlist state, used by --follow
+        self.last_sequence = -1
+        self.target_duration = 0.0
+        self.endlist = True
+
+class SegmentJob:
+    """A single segment of a title, as handed to the download engines."""
+    __slots__ = ('title', 'index', 'url', 'path', 'byte_range', 'duration', 'encrypted')
+
+    def __init__(self, title, index, url, path, byte_range=None, duration=0.0, encrypted=False):
+        self.title = title
+        self.index = index
+        self.url = url
+        self.path = path
+        self.byte_range = byte_range
+        self.duration = duration
+        self.encrypted = encrypted # Under an #EXT-X-KEY, so the body is ciphertext
+
+    @property
+    def verify(self):
+        """Returns the SegmentVerifier factory of the title, or None for encrypted segments, which cannot be checked."""
+        return None if self.encrypted else self.title.verify
+
+def build_headers(config, cookie=None):
+    """Returns the default request headers overridden by config.json and the Cookie, if any."""
+    current_headers = DEFAULT_HEADERS.copy()
+    current_headers.update(config.get('headers', {}))
+    # Add or update Cookie in the current headers
+    if cookie:
+        current_headers['Cookie'] = cookie
+    elif 'Cookie' in current_headers:
+        del current_headers['Cookie']
+    return current_headers
+
+def output_file_for(m3u8_url, output_dir):
+    """Derives the output file name from the playlist URL."""
+    final_output_file_name = os.path.basename(urlparse(m3u8_url).path).replace(".m3u8", ".mp4")
+    if not final_output_file_name or final_output_file_name == ".mp4":
+        final_output_file_name = "output.mp4"
+    return os.path.join(output_dir, final_output_file_name)
+
+def downloads_dir_for(output_file):
+    """Names the downloads directory of a title after its output file and a hash of the file's full path."""
+    # The hash keeps titles of the same name in different folders (S1/ep1.mp4, S2/ep1.mp4) apart
+    path_hash = hashlib.sha1(os.path.normcase(os.path.abspath(output_file)).encode('utf-8')).hexdigest()[:8]
+    stem = os.path.splitext(os.path.basename(output_file))[0]
+    return os.path.join(SCRIPT_DIR, "downloads", f"{stem}-{path_hash}")
+
+BYTERANGE_GROUP_SIZE = 16 * 1024 * 1024 # Adjacent byte ranges are fetched together up to this size
+
+def group_segments(segments, base_url, start=0):
+    """Yields (absolute URL, byte range, duration, encrypted) download units, merging adjacent byte ranges of the same resource."""
+    absolute_urls = [urljoin(base_url, uri) for uri in segments.uris]
+    group = None
+    for i in range(start, len(segments)):
+        url = absolute_urls[segments.uri_ids[i]]
+        byte_range = segments.byte_range(i)
+        duration = segments.durations[i]
+        encrypted = segments.key_ids[i] >= 0
+        if (group is not None and byte_range is not None and group[1] is not None and group[0] == url
+                and group[3] == encrypted
+                and group[1][0] + group[1][1] == byte_range[0]
+                and group[1][1] + byte_range[1] <= BYTERANGE_GROUP_SIZE):
+            group = (url, (group[1][0], group[1][1] + byte_range[1]), group[2] + duration, encrypted)
+            continue
+        if group is not None:
+            yield group
+        group = (url, byte_range, duration, encrypted)
+    if group is not None:
+        yield group
+
+def prepare_title(title, headers, lang_strings, session_pool, args):
+    """Fetches and parses the playlist of a title and queues its segments. Returns False if there is nothing to download."""
+    # --- Download M3U8 ---
+    m3u8_content = download_m3u8(title.m3u8_url, headers, lang_strings, session_pool, title.log)
+    if not m3u8_content:
+        return False
+
+    # --- Master playlist: pick one variant and continue with its media playlist ---
+    if is_master_playlist(m3u8_content):
+        variants = parse_master_playlist(m3u8_content, title.m3u8_url)
+        if not variants:
+            title.log(lang_strings["no_segments_found"])
+            return False
+        title.log(lang_strings["master_playlist_found"].format(count=len(variants)))
+        for variant in variants:
+            title.log(lang_strings["variant_info"].format(width=variant['width'], height=variant['height'],
+                                                      kbps=variant['bandwidth'] // 1000, url=variant['url']))
+        if args.probe_target:
+            variant = probe_variant(variants, headers, lang_strings, session_pool, args.probe_target * 60, log=title.log)
+        else:
+            variant = select_variant(variants, args.variant)
+        title.log(lang_strings["variant_selected"].format(width=variant['width'], height=variant['height'],
+                                                      kbps=variant['bandwidth'] // 1000))
+        # Segment URLs are relative to the media playlist, not the master
+        title.m3u8_url = variant['url']
+        m3u8_content = download_m3u8(title.m3u8_url, headers, lang_strings, session_pool, title.log)
+        if not m3u8_content:
+            return False
+
+    playlist = parse_m3u8(m3u8_content, lang_strings, title.log)
+    if playlist is None:
+        return False
+
+    # --- Create downloads directory ---
+    downloads_dir = title.downloads_dir
+    os.makedirs(downloads_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(title.output_file)), exist_ok=True)
+
+    # --- Streaming merge: segments go straight into the output file ---
+    # (always in follow mode, so live segments are appended as they arrive)
+    stream_merge = args.stream_merge or args.follow
+    if stream_merge and args.resume:
+        title.log(lang_strings["stream_merge_resume_conflict"])
+        stream_merge = False
+    if not stream_merge:
+        title.manifest = SegmentManifest(downloads_dir, resume=args.resume)
+
+    # --- Init segment: decoded from STAR-INIT-DATA, or fetched from #EXT-X-MAP before any media segment ---
+    title.init_segment = load_init_segment(title, playlist, headers, lang_strings, session_pool)
+    if title.init_segment is None and playlist.map_uri:
+        return False # fMP4 segments cannot be played without their init segment
+    track_ids = title.init_segment.track_ids if title.init_segment is not None else None
+
+    # Make segment URLs absolute and group byte ranges into jobs
+    segment_jobs = list(group_segments(playlist.segments, title.m3u8_url))
+
+    if not segment_jobs:
+        # Without segments there is only something to write if the playlist had an init segment
+        if title.init_segment is None:
+            title.log(lang_strings["no_segments_found"]) 
+            return False
+        title.log(lang_strings["no_additional_segments_to_download"])
+
+    if stream_merge:
+        # Opened only now that the title will be downloaded, so a failed title leaves an existing output alone
+        title.assembler = SegmentAssembler(title.output_file, downloads_dir, window=max(args.reorder_window, 1))
+        title.log(lang_strings["stream_merge_enabled"].format(file=title.output_file, window=title.assembler.window))
+        if title.init_segment is not None:
+            title.assembler.write_header(title.init_segment.data)
+
+    add_segment_jobs(title, segment_jobs)
+    if not args.no_verify:
+        # Segments are checked while they download, against the tracks of the init segment
+        title.verify = lambda: SegmentVerifier(track_ids)
+
+    title.downloader = Downloader()
+    title.downloader.total = len(title.jobs) # Total only for actual segments to be downloaded
+    title.downloader.total_duration = sum(job.duration for job in title.jobs)
+    title.last_sequence = playlist.segments.sequences[-1] if len(playlist.segments) else playlist.media_sequence - 1
+    title.target_duration = playlist.target_duration
+    title.endlist = playlist.endlist
+    return True
+
+def add_segment_jobs(title, segment_jobs):
+    """Appends (URL, byte range, duration, encrypted) download units to a title as SegmentJobs and returns the new jobs."""
+    new_jobs = []
+    for segment_url, byte_range, duration, encrypted in segment_jobs:
+        i = len(title.jobs)
+        ext = os.path.splitext(urlparse(segment_url).path)[1] or '.ts'
+        # Use a consistent naming convention for segments, init.mp4 is already handled separately
+        segment_filename = f"{i:05d}{ext}" 
+        job = SegmentJob(title, i, segment_url, os.path.join(title.downloads_dir, segment_filename), byte_range, duration, encrypted)
+        title.jobs.append(job)
+        new_jobs.append(job)
+    return new_jobs
+
+def refresh_live_title(title, playlist):
+    """Queues the segments of a reloaded live playlist that are newer than the last one seen. Returns the new jobs."""
+    segments = playlist.segments
+    start = 0
+    while start < len(segments) and segments.sequences[start] <= title.last_sequence:
+        start += 1
+    new_jobs = add_segment_jobs(title, group_segments(segments, title.m3u8_url, start))
+    if len(segments):
+        title.last_sequence = max(title.last_sequence, segments.sequences[-1])
+    title.target_duration = playlist.target_duration or title.target_duration
+    title.endlist = playlist.endlist
+    downloader = title.downloader
+    with downloader.lock:
+        downloader.total += len(new_jobs)
+        downloader.total_duration += sum(job.duration for job in new_jobs)
+    return new_jobs
+
+FOLLOW_IDLE_RELOADS = 20 # Unchanged reloads, half a target duration apart, before a live stream counts as ended
+
+def follow_titles(titles, headers, lang_strings, session_pool, max_workers, controller=None, retry_policy=None, metrics_file=None, transfer=None, on_progress=None, quiet=False):
+    """Downloads titles on one worker pool and keeps reloading the live/event ones, queueing their new segments, until #EXT-X-ENDLIST."""
+    reporter = ProgressReporter([title.downloader for title in titles], lang_strings, controller, metrics_file=metrics_file,
+                                callback=on_progress, quiet=quiet)
+    reporter.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_job = {}
+            def submit(jobs):
+                for job in jobs:
+                    future = submit_segment_job(executor, job, headers, lang_strings, session_pool, controller, retry_policy, transfer)
+                    future_to_job[future] = job
+
+            submit(schedule_jobs(titles))
+            # Next reload time, conditional-GET validators and unchanged reloads of each live title
+            next_reload = {title: time.time() + (title.target_duration or 5.0) for title in titles if not title.endlist}
+            validators = {title: {} for title in next_reload}
+            idle_reloads = {title: 0 for title in next_reload}
+            try:
+                while next_reload:
+                    title = min(next_reload, key=next_reload.get)
+                    time.sleep(max(next_reload[title] - time.time(), 0))
+                    poll_headers, generation = header_snapshot(headers)
+                    try:
+                        m3u8_content, validators[title] = poll_playlist(title.m3u8_url, poll_headers, session_pool, validators[title])
+                    except requests.exceptions.RequestException as e:
+                        if refresh_expired_headers(headers, e, generation):
+                            # Reload again straight away with the renewed headers
+                            next_reload[title] = time.time()
+                            continue
+                        title.log(lang_strings["follow_poll_failed"].format(url=title.m3u8_url, error=e))
+                        m3u8_content = None
+                    new_jobs = []
+                    if m3u8_content is not None:
+                        new_jobs = refresh_live_title(title, parse_media_playlist(m3u8_content))
+                    if new_jobs:
+                        idle_reloads[title] = 0
+                        title.log(lang_strings["follow_new_segments"].format(count=len(new_jobs), url=title.m3u8_url))
+                        submit(new_jobs)
+                    else:
+                        idle_reloads[title] += 1
+                    if title.endlist:
+                        title.log(lang_strings["follow_endlist"].format(url=title.m3u8_url))
+                        del next_reload[title]
+                    elif idle_reloads[title] >= FOLLOW_IDLE_RELOADS:
+                        title.log(lang_strings["follow_idle_stop"].format(url=title.m3u8_url))
+                        del next_reload[title]
+                    else:
+                        # Reload every target duration, or half of it while nothing changes (RFC 8216, 6.3.4)
+                        interval = title.target_duration or 5.0
+                        next_reload[title] = time.time() + (interval / 2 if idle_reloads[title] else interval)
+            except KeyboardInterrupt:
+                # Stop reloading but keep the segments already queued
+                titles[0].log(lang_strings["follow_stopped"])
+            report_segment_results(future_to_job, lang_strings)
+    finally:
+        reporter.stop()
+
+def schedule_jobs(titles):
+    """Interleaves the segments of all titles round-robin so the workers are shared fairly between them."""
+    jobs = []
+    for round_jobs in itertools.zip_longest(*(title.jobs for title in titles)):
+        jobs.extend(job for job in round_jobs if job is not None)
+    return jobs
+
+def run_segment_jobs(jobs, headers, lang_strings, engine, session_pool, max_workers, controller=None, retry_policy=None, metrics_file=None, transfer=None, on_progress=None, quiet=False):
+    """Downloads SegmentJobs, from any number of titles, on the selected engine."""
+    downloaders = list(OrderedDict.fromkeys(job.title.downloader for job in jobs))
+    reporter = ProgressReporter(downloaders, lang_strings, controller, metrics_file=metrics_file, callback=on_progress, quiet=quiet)
+    reporter.start()
+    try:
+        run_engine(jobs, headers, lang_strings, engine, session_pool, max_workers, controller, retry_policy, transfer)
+    finally:
+        reporter.stop()
+
+def run_engine(jobs, headers, lang_strings, engine, session_pool, max_workers, controller=None, retry_policy=None, transfer=None):
+    """Runs an engine: 'thread', 'async', or a callable taking the same arguments as download_segments_threaded."""
+    if callable(engine):
+        engine(jobs, headers, lang_strings, session_pool, max_workers, controller, retry_policy, transfer)
+    elif engine == 'async':
+        download_segments_async(jobs, headers, lang_strings, max_workers, retry_policy, transfer)
+    else:
+        # Use ThreadPoolExecutor for concurrent downloads; the controller
+        # decides how many of the max_workers threads may download at once.
+        download_segments_threaded(jobs, headers, lang_strings, session_pool, max_workers, controller, retry_policy, transfer)
+
+class DownloadPipeline:
+    """The engine, retry and transfer settings, connection pool and segment cache shared by the titles of one run."""
+    def __init__(self, args, config, lang_strings, engine=None, config_file=CONFIG_FILE, log=print):
+        self.args = args
+        self.lang_strings = lang_strings
+        self.log = log
+        self.engine, self.max_workers, self.controller = select_engine(args, config, lang_strings, log)
+        if engine is not None:
+            self.engine = engine # A callable engine given to DownloadJob
+        self.retry_policy = load_retry_policy(config)
+        self.transfer = load_transfer_settings(config, config_file)
+        # Each worker may open extra connections for the parts of a large segment
+        self.session_pool = SessionPool(max_workers=self.max_workers * max(self.transfer.split_parts, 1))
+        self.transfer.start_part_workers(self.max_workers * (self.transfer.split_parts - 1))
+        self.cache = load_segment_cache(args, config)
+
+    @property
+    def workers(self):
+        return self.controller.limit if self.controller is not None else self.max_workers
+
+    def download(self, titles, headers, on_progress=None, quiet=False):
+        """Downloads the segments of prepared titles, and keeps following the live ones with --follow."""
+        if self.args.follow and any(not title.endlist for title in titles):
+            follow_titles(titles, headers, self.lang_strings, self.session_pool, self.max_workers, self.controller,
+                          self.retry_policy, self.args.metrics_file, self.transfer, on_progress, quiet)
+            return
+        jobs = schedule_jobs(titles)
+        if jobs:
+            run_segment_jobs(jobs, headers, self.lang_strings, self.engine, self.session_pool, self.max_workers,
+                             self.controller, self.retry_policy, self.args.metrics_file, self.transfer, on_progress, quiet)
+
+    def print_stats(self):
+        print_connection_stats(self.engine, self.session_pool, self.lang_strings, self.log)
+        print_cache_stats(self.cache, self.lang_strings, self.log)
+
+    def close(self):
+        self.transfer.close()
+        self.session_pool.close()
+
+def finish_title(title, lang_strings, args):
+    """Reports the download of a title and combines its segments. Returns True if the output file was written."""
+    downloader = title.downloader
+    if title.manifest is not None:
+        title.manifest.close()
+    if title.jobs:
+        title.log(f"\n{lang_strings['download_summary'].format(completed=downloader.completed, failed=downloader.failed, retries=downloader.retries, total=downloader.total)}")
+        if title.manifest is not None and args.resume:
+            title.log(lang_strings["resume_summary"].format(reused=title.manifest.reused))
+        if downloader.invalid:
+            title.log(lang_strings["verify_summary"].format(invalid=downloader.invalid))
+    else:
+        title.log(lang_strings["no_segments_to_download_summary"])
+
+    # --- Combine Segments ---
+    if title.assembler is not None:
+        # Segments were already appended in order during the download
+        title.assembler.finish()
+        title.log(lang_strings["combine_success"])
+        return True
+    # Call the pure Python binary combine function with the segments of this run, headed by the in-memory init segment
+    header = title.init_segment.data if title.init_segment is not None else None
+    return combine_segments_py_binary(title.downloads_dir, title.output_file, lang_strings, header=header, log=title.log,
+                                      segment_files=[job.path for job in title.jobs])
+
+def print_connection_stats(engine, session_pool, lang_strings, log=print):
+    if engine != 'async':
+        opened, sent = session_pool.stats()
+        log(lang_strings["connection_stats"].format(requests=sent, connections=opened, reused=max(sent - opened, 0)))
+
+def print_cache_stats(cache, lang_strings, log=print):
+    if cache is not None:
+        log(lang_strings["cache_summary"].format(hits=cache.hits, misses=cache.misses, mb=cache.size / (1024 * 1024),
+                                                   directory=cache.cache_dir))
+
+def read_header_file(path):
+    """Reads request headers from a JSON object or from 'Name: value' lines."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_header_text(f.read())
+
+def parse_header_text(text):
+    """Parses request headers from a JSON object or from 'Name: value' lines."""
+    if text.lstrip().startswith('{'):
+        return json.loads(text)
+    headers = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(':')
+        if sep and name.strip() and not line.startswith('#'):
+            headers[name.strip()] = value.strip()
+    return headers
+
+def read_batch_file(path):
+    """Reads 'URL [output name]' lines from a batch file, skipping blank lines and # comments."""
+    items = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            items.append((parts[0], parts[1].strip() if len(parts) > 1 else None))
+    return items
+
+def run_batch(args, config, lang_strings):
+    """Downloads many playlists non-interactively through one shared segment scheduler. Returns the exit code."""
+    pipeline = DownloadPipeline(args, config, lang_strings)
+    items = [(url, None) for url in args.urls]
+    if args.batch:
+        items.extend(read_batch_file(args.batch))
+
+    output_dir = args.output_dir or SCRIPT_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    headers = load_request_headers(args, config, lang_strings, args.cookie)
+
+    titles = []
+    used_outputs = set()
+    used_dirs = set()
+    for m3u8_url, name in items:
+        if not (m3u8_url.startswith("http://") or m3u8_url.startswith("https://")):
+            print(lang_strings["error_m3u8_url_prefix"])
+            continue
+        if args.output:
+            output_file = args.output
+        elif name:
+            output_file = os.path.join(output_dir, name if name.lower().endswith('.mp4') else name + '.mp4')
+        else:
+            output_file = output_file_for(m3u8_url, output_dir)
+        # Playlists are often all called index.m3u8, so keep output names apart
+        stem, ext = os.path.splitext(output_file)
+        n = 2
+        while output_file in used_outputs:
+            output_file = f"{stem}_{n}{ext}"
+            n += 1
+        used_outputs.add(output_file)
+
+        # Each title gets its own downloads directory
+        downloads_dir = base_dir = downloads_dir_for(output_file)
+        n = 2
+        while downloads_dir in used_dirs:
+            downloads_dir = f"{base_dir}_{n}"
+            n += 1
+        used_dirs.add(downloads_dir)
+        title = TitleDownload(m3u8_url, output_file, downloads_dir, pipeline.cache)
+        print("\n" + lang_strings["batch_title_header"].format(number=len(titles) + 1, url=m3u8_url, file=output_file))
+        if prepare_title(title, headers, lang_strings, pipeline.session_pool, args):
+            titles.append(title)
+
+    jobs = schedule_jobs(titles)
+    live_titles = [title for title in titles if not title.endlist] if args.follow else []
+    if jobs or live_titles:
+        print(lang_strings["batch_start"].format(titles=len(titles), count=len(jobs), workers=pipeline.workers))
+    # Live titles keep feeding new segments into the same pool as the finished ones
+    for title in live_titles:
+        print(lang_strings["follow_live_playlist"].format(url=title.m3u8_url, interval=title.target_duration))
+    pipeline.download(titles, headers)
+
+    succeeded = 0
+    for number, title in enumerate(titles, 1):
+        print("\n" + "=" * 60)
+        print(lang_strings["batch_title_header"].format(number=number, url=title.m3u8_url, file=title.output_file))
+        if finish_title(title, lang_strings, args) and title.downloader.completed == title.downloader.total:
+            succeeded += 1
+            if args.cleanup:
+                cleanup_files(lang_strings, title.downloads_dir)
+        else:
+            print(lang_strings["combine_process_error"])
+    pipeline.print_stats()
+    pipeline.close()
+
+    print("\n" + lang_strings["batch_summary"].format(succeeded=succeeded, total=len(items)))
+    return 0 if succeeded == len(items) else 1
+
+# --- Library API ---
+
+class DownloadResult:
+    """Outcome of a DownloadJob."""
+    def __init__(self, output_file, success, completed=0, failed=0, retries=0, total=0, bytes_received=0, seconds=0.0,
+                 connections=0, requests_sent=0, cache_hits=0, cache_misses=0):
+        self.output_file = output_file
+        self.success = success # True if every segment was downloaded and the video was written
+        self.completed = completed
+        self.failed = failed
+        self.retries = retries
+        self.total = total
+        self.bytes_received = bytes_received
+        self.seconds = seconds
+        self.connections = connections # Opened and used by the threaded engine and the playlist requests
+        self.requests_sent = requests_sent
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
+
+    def __repr__(self):
+        return (f"DownloadResult(output_file={self.output_file!r}, success={self.success}, "
+                f"completed={self.completed}/{self.total}, failed={self.failed})")
+
+def discard_output(*args, **kwargs):
+    """Stands in for print in a quiet DownloadJob."""
+
+class DownloadJob:
+    """Downloads one M3U8 playlist into a video file without any prompts, for use from other Python code.
+
+    Any long command line option can be given as a keyword argument, e.g.
+    DownloadJob(url, 'video.mp4', cookie='...', stream_merge=True, on_progress=print).run().
+    engine is 'thread', 'async', or a callable with the arguments of download_segments_threaded.
+    on_progress is called about twice a second with a dict of counters ('completed', 'total', 'bytes', 'rate_bps', ...).
+    config defaults to config.json, read when the job runs; quiet keeps the job from printing anything.
+    """
+    def __init__(self, m3u8_url, output_file=None, cookie=None, headers=None, engine='thread', workers=None,
+                 on_progress=None, quiet=False, language='en', config=None, downloads_dir=None, **options):
+        self.options = parse_args([])
+        for name, value in options.items():
+            if not hasattr(self.options, name) or name in ('urls', 'batch'):
+                raise TypeError(f"unknown option: {name}")
+            setattr(self.options, name, value)
+        if variant_syntax_error(self.options.variant):
+            raise ValueError(variant_syntax_error(self.options.variant))
+        self.options.engine = engine if isinstance(engine, str) else 'thread'
+        self.options.workers = workers
+        self.m3u8_url = m3u8_url
+        self.output_file = output_file or output_file_for(m3u8_url, self.options.output_dir or os.getcwd())
+        self.downloads_dir = downloads_dir or downloads_dir_for(self.output_file)
+        self.cookie = cookie
+        self.headers = headers or {}
+        self.engine = engine
+        self.on_progress = on_progress
+        self.quiet = quiet
+        self.language = language
+        self.config = config
+
+    def run(self):
+        """Downloads and merges the playlist. Returns a DownloadResult; failed downloads do not raise."""
+        # Output goes through a log function rather than a redirected sys.stdout, which other threads share
+        log = discard_output if self.quiet else print
+        args = self.options
+        config = self.config if self.config is not None else load_config()
+        lang_strings = load_language_strings(self.language)
+        # A config given by the caller must not be overridden by later edits of config.json
+        pipeline = DownloadPipeline(args, config, lang_strings, self.engine if callable(self.engine) else None,
+                                    CONFIG_FILE if self.config is None else None, log)
+        headers = load_request_headers(args, config, lang_strings, self.cookie, self.headers, log)
+        title = TitleDownload(self.m3u8_url, self.output_file, self.downloads_dir, pipeline.cache, log)
+        started = time.time()
+        try:
+            if prepare_title(title, headers, lang_strings, pipeline.session_pool, args):
+                pipeline.download([title], headers, self.on_progress, self.quiet)
+                success = finish_title(title, lang_strings, args) and title.downloader.completed == title.downloader.total
+            else:
+                success = False
+            opened, sent = pipeline.session_pool.stats()
+        finally:
+            pipeline.close()
+        if success and args.cleanup:
+            cleanup_files(lang_strings, title.downloads_dir, log)
+        downloader = title.downloader or Downloader() # Not set up if the playlist could not be loaded
+        cache = pipeline.cache
+        return DownloadResult(self.output_file, success, downloader.completed, downloader.failed, downloader.retries,
+                              downloader.total, downloader.bytes_received, time.time() - started, opened, sent,
+                              cache.hits if cache is not None else 0, cache.misses if cache is not None else 0)
 
 # --- Main Logic ---
 
-# ... (rest of the imports and classes remain the same)
+def parse_args(argv=None):
+    """Parses command line options."""
+    parser = argparse.ArgumentParser(description="StarTimes video downloader & merger")
+    parser.add_argument('urls', nargs='*', metavar='URL',
+                        help="M3U8 URLs to download without prompting (batch mode)")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="file with one 'URL [output name]' per line to download without prompting")
+    parser.add_argument('--cookie', default=None,
+                        help="Cookie value used in batch mode")
+    parser.add_argument('--auth-token', default=None, metavar='TOKEN',
+                        help="Authorization token (as used by cookie-tool.py) to renew the request headers when they expire")
+    parser.add_argument('--auth-url', default=None, metavar='URL',
+                        help="ad-gslb endpoint that --auth-token is sent to (default: the StarTimes one, or 'auth.url' in config.json)")
+    parser.add_argument('--header-file', default=None, metavar='FILE',
+                        help="extra request headers, as a JSON object or 'Name: value' lines (e.g. X-PlayID)")
+    parser.add_argument('--output', '-o', default=None, metavar='FILE',
+                        help="output file when downloading a single URL")
+    parser.add_argument('--no-prompt', action='store_true',
+                        help="never prompt; fail instead of asking for a missing URL")
+    parser.add_argument('--output-dir', default=None,
+                        help="directory for the merged videos in batch mode (default: the script directory)")
+    parser.add_argument('--cleanup', action='store_true',
+                        help="in batch mode, delete each title's downloaded segments after a successful merge")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help="download engine: 'thread' (default) or 'async' (requires aiohttp)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="fixed number of concurrent downloads (default: adaptive between the config.json limits, or 200 in-flight requests for async)")
+    parser.add_argument('--stream-merge', action='store_true',
+                        help="write segments into the output file in order while downloading instead of merging afterwards")
+    parser.add_argument('--reorder-window', type=int, default=64,
+                        help="segments held in memory while waiting for an earlier one (default: 64); later arrivals spill to disk")
+    parser.add_argument('--variant', default='best',
+                        help="variant of a master playlist: best (default), worst, a resolution like 720p or 1280x720, or a bandwidth cap like <=2000000")
+    parser.add_argument('--probe-target', type=float, default=None, metavar='MINUTES',
+                        help="probe the link on a few segments and pick the highest variant that downloads within MINUTES")
+    parser.add_argument('--metrics-file', default=None, metavar='PATH',
+                        help="append JSON-lines download metrics (throughput, latency percentiles, per-host stats) to PATH")
+    parser.add_argument('--resume', action='store_true',
+                        help="reuse segments completed by an interrupted run and continue partial ones")
+    parser.add_argument('--cache-dir', default=None, metavar='DIR',
+                        help="keep downloaded segments in DIR and reuse them in later runs and across titles (size cap in config.json)")
+    parser.add_argument('--no-verify', action='store_true',
+                        help="do not check that segments are valid MPEG-TS/fMP4 before merging them")
+    parser.add_argument('--follow', action='store_true',
+                        help="keep reloading live/event playlists and append new segments until they end (Ctrl+C stops early; uses the thread engine)")
+    args = parser.parse_args(argv)
+    if args.output and (args.batch or len(args.urls) > 1):
+        parser.error("--output can only be used with a single URL")
+    if args.no_prompt and not (args.urls or args.batch):
+        parser.error("a URL or --batch FILE is required with --no-prompt")
+    if variant_syntax_error(args.variant):
+        parser.error(variant_syntax_error(args.variant))
+    return args
+
+def load_retry_policy(config):
+    """Builds the retry policy from the optional 'retry' section of config.json."""
+    settings = config.get('retry', {})
+    defaults = RetryPolicy()
+    return RetryPolicy(
+        max_retries=settings.get('max_retries', defaults.max_retries),
+        base_delay=settings.get('base_delay', defaults.base_delay),
+        max_delay=settings.get('max_delay', defaults.max_delay),
+        budget_ratio=settings.get('budget_ratio', defaults.budget_ratio),
+        budget_minimum=settings.get('budget_minimum', defaults.budget_minimum),
+        breaker_threshold=settings.get('breaker_threshold', defaults.breaker_threshold),
+        breaker_cooldown=settings.get('breaker_cooldown', defaults.breaker_cooldown)
+    )
+
+def load_transfer_settings(config, config_file=CONFIG_FILE):
+    """Builds the chunk size and segment splitting settings from the optional 'transfer' section of config.json.
+
+    config_file is watched for rate limit changes; None keeps the limits of config for the whole run.
+    """
+    settings = config.get('transfer', {})
+    defaults = TransferSettings()
+    return TransferSettings(
+        chunk_size=settings.get('chunk_size', defaults.chunk_size),
+        split_threshold=settings.get('split_threshold', defaults.split_threshold),
+        split_parts=settings.get('split_parts', defaults.split_parts),
+        limiter=load_rate_limiter(config, config_file)
+    )
 
-def main():
+def load_rate_limiter(config, config_file=CONFIG_FILE):
+    """Builds the shared rate limiter from the optional 'rate_limit' section of config.json (no limits without one)."""
+    settings = config.get('rate_limit', {})
+    # Watching config.json lets limits be added or changed during a long batch
+    return RateLimiter(
+        bytes_per_second=settings.get('bytes_per_second', 0),
+        requests_per_second=settings.get('requests_per_second', 0),
+        host_bytes_per_second=settings.get('host_bytes_per_second', 0),
+        host_requests_per_second=settings.get('host_requests_per_second', 0),
+        config_file=config_file
+    )
+
+def load_segment_cache(args, config):
+    """Opens the segment cache named by --cache-dir or the optional 'cache' section of config.json, if any."""
+    settings = config.get('cache', {})
+    cache_dir = args.cache_dir or settings.get('dir')
+    if not cache_dir:
+        return None
+    return SegmentCache(
+        os.path.join(SCRIPT_DIR, cache_dir),
+        max_bytes=int(settings.get('max_size_mb', 2048) * 1024 * 1024),
+        strip_params=settings.get('strip_params', SegmentCache.DEFAULT_STRIP_PARAMS)
+    )
+
+cookie_tool = None # cookie-tool.py, loaded by load_cookie_tool() when headers are refreshed
+
+def load_cookie_tool():
+    """Imports cookie-tool.py from next to this script, whose file name is not a valid module name."""
+    global cookie_tool
+    if cookie_tool is None:
+        spec = importlib.util.spec_from_file_location("cookie_tool", os.path.join(SCRIPT_DIR, "cookie-tool.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        cookie_tool = module
+    return cookie_tool
+
+def parse_header_propertys(value):
+    """Returns the request headers in the header_propertys field of an ad-gslb response."""
+    if isinstance(value, str):
+        value = parse_header_text(value)
+    elif isinstance(value, list):
+        # [{"key": name, "value": value}, ...]
+        value = {item.get('key', item.get('name')): item.get('value') for item in value if isinstance(item, dict)}
+    if not isinstance(value, dict) or not value:
+        raise ValueError("no header_propertys in the ad-gslb response")
+    return {str(name): str(header) for name, header in value.items() if name and header is not None}
+
+def load_header_provider(headers, args, config, lang_strings, log=print):
+    """Wraps headers in a HeaderProvider that renews them through cookie-tool.py when an Authorization token is set.
+
+    The token and the optional ad-gslb URL, query parameters and refresh interval come from --auth-token,
+    --auth-url or the 'auth' section of config.json. Without a token the headers are returned unchanged.
+    """
+    settings = config.get('auth', {})
+    token = args.auth_token or settings.get('token')
+    if not token:
+        return headers
+    if not token.lower().startswith('bearer '):
+        token = 'Bearer ' + token
+    tool = load_cookie_tool()
+    url = args.auth_url or settings.get('url') or tool.AD_GSLB_URL
+    params = settings.get('params')
+
+    def refresher():
+        response = tool.request_header_propertys(token, url=url, params=params, timeout=30)
+        return parse_header_propertys(response.json().get('header_propertys'))
+
+    return HeaderProvider(headers, refresher, refresh_interval=settings.get('refresh_interval', 0),
+                          min_interval=settings.get('min_interval', 10), lang_strings=lang_strings, log=log)
+
+def load_request_headers(args, config, lang_strings, cookie=None, extra_headers=None, log=print):
+    """Returns the request headers of a run: defaults, config.json, the Cookie, --header-file and extra_headers, in that order."""
+    headers = build_headers(config, cookie)
+    if args.header_file:
+        headers.update(read_header_file(args.header_file))
+    headers.update(extra_headers or {})
+    if 'Cookie' not in headers:
+        log(lang_strings["warning_no_cookie"])
+    # Shared by all workers, and renewed when they expire if an Authorization token is set
+    return load_header_provider(headers, args, config, lang_strings, log)
+
+def select_engine(args, config, lang_strings, log=print):
+    """Returns the download engine, its maximum concurrency and the adaptive controller, if any."""
+    engine = args.engine
+    if engine == 'async' and load_aiohttp() is None:
+        log(lang_strings["aiohttp_missing"])
+        engine = 'thread'
+    if args.workers or engine == 'async':
+        return engine, args.workers or 200, None
+    # Threaded downloads adapt between the limits in config.json unless --workers fixes them
+    limits = config.get('concurrency', {})
+    controller = ConcurrencyController(
+        initial=limits.get('initial', 10),
+        minimum=limits.get('min', 2),
+        maximum=limits.get('max', 32)
+    )
+    return engine, controller.maximum, controller
+
+def main(argv=None):
+    args = parse_args(argv)
     config = load_config()
+    batch_mode = bool(args.urls or args.batch)
     
     # --- Language Selection ---
     lang_code = config.get('language')
+    if not lang_code and batch_mode:
+        lang_code = 'en' # Never prompt in batch mode
     if not lang_code:
         print("Please choose a language (1 for English, 2 for Chinese):")
         print("请选择语言/ (1 为英文, 2 为中文):")
@@ -247,6 +2926,13 @@ def main():
     print(lang_strings["titlea"])
     print("=" * 60)
 
+    if batch_mode:
+        try:
+            sys.exit(run_batch(args, config, lang_strings))
+        except KeyboardInterrupt:
+            print(lang_strings["user_interrupted"])
+            sys.exit(130)
+
     try:
         # --- M3U8 URL Input ---
         m3u8_url = input(lang_strings["m3u8_url_prompt"]).strip()
@@ -255,37 +2941,15 @@ def main():
             m3u8_url = input(lang_strings["m3u8_url_prompt"]).strip()
 
         # --- Load or Initialize Headers ---
-        default_headers = {
-            'User-Agent': 'Mozilla/5.0 (Linux; Android 14) StarTimesON/6.16.5-1',
-            'Accept': '*/*',
-            'Range': 'bytes=0-',
-            'Connection': 'close',
-            'Icy-MetaData': '1',
-            'Accept-Encoding': 'gzip',
-            'Content-Type': 'text/plain',
-            'X-UserID': '123456789',
-            'X-DeviceID': 'abcdefghijklmnopqrstyvwxyzabcdef_android',
-            'X-EventID': 'VOD-mynameis-1145-1419-1910-muyuegithub1',
-            'X-PlayID': 'adbcdefg-1a2b-1145-3c4d-114514191910'
-        }
-        
         headers_from_config = config.get('headers', {})
-        current_headers = default_headers.copy()
-        current_headers.update(headers_from_config)
 
         # Prompt for cookie value
         user_cookie = input(lang_strings["cookie_prompt"]).strip()
-        if not user_cookie:
-            print(lang_strings["warning_no_cookie"])
         
-        # Add or update Cookie in the current headers
-        if user_cookie:
-            current_headers['Cookie'] = user_cookie
-        elif 'Cookie' in current_headers:
-            del current_headers['Cookie']
+        current_headers = build_headers(config, user_cookie)
 
         # Save non-Cookie headers back to config
-        if not headers_from_config or headers_from_config != {k: v for k, v in default_headers.items()}:
+        if not headers_from_config or headers_from_config != {k: v for k, v in DEFAULT_HEADERS.items()}:
             headers_to_save = {k: v for k, v in current_headers.items() if k != 'Cookie'}
             if headers_to_save != config.get('headers', {}):
                 config['headers'] = headers_to_save
@@ -294,119 +2958,31 @@ def main():
                 print(lang_strings["headers_info_prompt"])
 
 
-        # --- Download M3U8 ---
-        m3u8_content = download_m3u8(m3u8_url, current_headers, lang_strings)
-        if not m3u8_content:
-            input(lang_strings["press_enter_to_exit"])
-            sys.exit(1)
+        current_headers = load_request_headers(args, config, lang_strings, user_cookie)
 
-        init_segment_url, segments, star_init_data = parse_m3u8(m3u8_content, lang_strings)
+        # --- Download engine and shared keep-alive connection pool ---
+        pipeline = DownloadPipeline(args, config, lang_strings)
 
-        # --- Create downloads directory ---
         downloads_dir = os.path.join(SCRIPT_DIR, "downloads")
-        os.makedirs(downloads_dir, exist_ok=True)
-
-        # --- Handle STAR-INIT-DATA as a binary init.mp4 ---
-        if star_init_data:
-            init_mp4_path = os.path.join(downloads_dir, "init.mp4")
-            try:
-                # 1. Base64 Decode
-                base64_decoded_data = base64.b64decode(star_init_data)
-                
-                # 2. Zlib Decompress
-                decompressed_data = zlib.decompress(base64_decoded_data) # Add this line
-
-                with open(init_mp4_path, 'wb') as f:
-                    f.write(decompressed_data) # Write the decompressed data
-                print(lang_strings["star_init_data_saved_as_init_mp4"].format(path=init_mp4_path))
-                
-                # If STAR-INIT-DATA was used for init.mp4, clear init_segment_url
-                # to prevent it from being added to the download list.
-                # This handles cases where init_segment_url points to the same content.
-                if init_segment_url:
-                    print(lang_strings["removed_redundant_init_segment_url"])
-                    init_segment_url = None # Nullify it so it's not re-added to segments
-                
-            except (binascii.Error, zlib.error, Exception) as e: # Catch zlib errors too
-                print(lang_strings["failed_to_save_star_init_data"].format(error=e))
-        
-        # Make segment URLs absolute
-        processed_segments = []
-        if init_segment_url: # Only add if it wasn't handled by STAR-INIT-DATA
-            if not (init_segment_url.startswith("http://") or init_segment_url.startswith("https://")):
-                processed_segments.append(urljoin(m3u8_url, init_segment_url))
-            else:
-                processed_segments.append(init_segment_url)
-        
-        for segment in segments:
-            if not (segment.startswith("http://") or segment.startswith("https://")):
-                processed_segments.append(urljoin(m3u8_url, segment))
-            else:
-                processed_segments.append(segment)
-        segments = processed_segments
-
+        final_output_file = output_file_for(m3u8_url, SCRIPT_DIR)
+        title = TitleDownload(m3u8_url, final_output_file, downloads_dir, pipeline.cache)
+        if not prepare_title(title, current_headers, lang_strings, pipeline.session_pool, args):
+            input(lang_strings["press_enter_to_exit"])
+            sys.exit(1)
 
         # --- Download Segments ---
-        if not segments:
-            # If no segments *and* no init.mp4 was saved from STAR-INIT-DATA, then it's an issue.
-            # However, if init.mp4 was saved, the download can proceed with 0 segments if that's the case.
-            if not os.path.exists(os.path.join(downloads_dir, "init.mp4")):
-                print(lang_strings["no_segments_found"]) 
-                input(lang_strings["press_enter_to_exit"])
-                sys.exit(1)
-            else:
-                print(lang_strings["no_additional_segments_to_download"])
-
-
-        downloader = Downloader()
-        downloader.total = len(segments) # Total only for actual segments to be downloaded
-        
-        if len(segments) > 0:
-            print(lang_strings["start_downloading_segments"].format(count=len(segments)))
-            
-            # Use ThreadPoolExecutor for concurrent downloads
-            max_workers = 10
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_segment = {}
-                for i, segment_url in enumerate(segments):
-                    ext = os.path.splitext(urlparse(segment_url).path)[1] or '.ts'
-                    # Use a consistent naming convention for segments, init.mp4 is already handled separately
-                    segment_filename = f"{i:05d}{ext}" 
-                    segment_path = os.path.join(downloads_dir, segment_filename)
-                    
-                    future = executor.submit(
-                        download_segment, 
-                        segment_url, 
-                        current_headers, 
-                        segment_path,
-                        lang_strings, 
-                        downloader
-                    )
-                    future_to_segment[future] = segment_url
-                
-                for future in concurrent.futures.as_completed(future_to_segment):
-                    segment_url = future_to_segment[future]
-                    try:
-                        success = future.result()
-                        if not success:
-                            print(lang_strings["segment_download_failed_summary"].format(url=segment_url))
-                    except Exception as exc:
-                        print(lang_strings["segment_download_exception"].format(url=segment_url, error=exc))
-            
-            print(f"\n{lang_strings['download_summary'].format(completed=downloader.completed, failed=downloader.failed, total=downloader.total)}")
-        else:
-            print(lang_strings["no_segments_to_download_summary"])
+        if args.follow and not title.endlist:
+            print(lang_strings["follow_live_playlist"].format(url=title.m3u8_url, interval=title.target_duration))
+        elif title.jobs:
+            print(lang_strings["start_downloading_segments"].format(count=len(title.jobs)))
+        pipeline.download([title], current_headers)
 
+        combined = finish_title(title, lang_strings, args)
+        if title.jobs:
+            pipeline.print_stats()
+        pipeline.close()
 
-        # --- Combine Segments ---
-        final_output_file_name = os.path.basename(urlparse(m3u8_url).path).replace(".m3u8", ".mp4")
-        if not final_output_file_name or final_output_file_name == ".mp4":
-            final_output_file_name = "output.mp4"
-            
-        final_output_file = os.path.join(SCRIPT_DIR, final_output_file_name)
-        
-        # Call the pure Python binary combine function
-        if combine_segments_py_binary(downloads_dir, final_output_file, lang_strings):
+        if combined:
             print("\n" + "=" * 60)
             print(lang_strings["final_output_file"].format(file=final_output_file))
             
@@ -0,0 +1,362 @@
+import argparse
+import base64
+import hashlib
+import http.server
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DOWNLOADER_FILE = os.path.join(SCRIPT_DIR, "StarTimes-Video-Download-Tool-inti.py")
+
+# --- Mock HLS/CDN server ---
+
+INIT_DATA = b'ftyp' + b'\x00' * 60 # Stands in for the init segment carried in STAR-INIT-DATA
+AUTH_TOKEN = 'Bearer bench' # Authorization accepted by the stand-in ad-gslb endpoint
+
+def segment_bytes(index, size):
+    """Returns the synthetic content of a segment: whole MPEG-TS packets whose payload depends on the index."""
+    packet = b'\x47' + index.to_bytes(4, 'big') + bytes([index % 256]) * 183
+    return packet * max(size // 188, 1)
+
+def playlist_text(settings):
+    """Returns a media playlist like the StarTimes ones: #EXT-X-MAP with STAR-INIT-DATA, then the segments."""
+    init_data = base64.b64encode(zlib.compress(INIT_DATA)).decode()
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0',
+             f'#EXT-X-MAP:URI="init.mp4",STAR-INIT-DATA="{init_data}"']
+    for i in range(settings['segments']):
+        lines.append('#EXTINF:4.000,')
+        lines.append(f'seg/{i}.ts?token=bench')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+class MockCDNServer(http.server.ThreadingHTTPServer):
+    """Serves the synthetic playlist and segments, injecting latency, jitter, bandwidth caps and errors."""
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, MockCDNHandler)
+        self.settings = settings
+        self.random = random.Random(settings['seed'])
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'requests': 0, 'errors_injected': 0, 'bytes_sent': 0, 'auth_issued': 0, 'auth_rejected': 0}
+        self.segment_cache = {}
+        self.play_ids = {} # X-PlayID issued by the stand-in ad-gslb endpoint -> expiry time
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def issue_play_id(self):
+        with self.lock:
+            self.stats['auth_issued'] += 1
+            play_id = f"bench-{self.stats['auth_issued']}"
+            self.play_ids[play_id] = time.monotonic() + self.settings['auth_expiry']
+            return play_id
+
+    def authorized(self, play_id):
+        with self.lock:
+            return self.play_ids.get(play_id, 0) > time.monotonic()
+
+class MockCDNHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, so connection reuse can be measured
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections') # One TCP (and, on a real CDN, TLS) handshake
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        settings = self.server.settings
+        self.server.count('requests')
+        path = self.path.split('?', 1)[0]
+        if path == '/stats':
+            with self.server.lock:
+                body = json.dumps(self.server.stats).encode()
+            return self.send_body(body, 'application/json')
+        if path == '/index.m3u8':
+            return self.send_body(playlist_text(settings).encode(), 'application/vnd.apple.mpegurl')
+        if path == '/ad-gslb':
+            # Stands in for the StarTimes ad-gslb endpoint that cookie-tool.py calls
+            if self.headers.get('Authorization') != AUTH_TOKEN:
+                return self.send_empty(401)
+            body = json.dumps({'header_propertys': {'X-PlayID': self.server.issue_play_id()}}).encode()
+            return self.send_body(body, 'application/json')
+        if not (path.startswith('/seg/') and path.endswith('.ts')):
+            return self.send_empty(404)
+        index = int(path[len('/seg/'):-len('.ts')])
+        if index >= settings['segments']:
+            return self.send_empty(404)
+        if settings['auth_expiry'] and not self.server.authorized(self.headers.get('X-PlayID')):
+            self.server.count('auth_rejected')
+            return self.send_empty(403)
+
+        # Latency plus random jitter makes segments complete out of order
+        delay = settings['latency'] + self.server.draw() * settings['jitter']
+        if delay:
+            time.sleep(delay)
+        if self.server.draw() < settings['error_rate']:
+            self.server.count('errors_injected')
+            return self.send_empty(settings['error_status'], {'Retry-After': '0'} if settings['error_status'] in (429, 503) else None)
+
+        with self.server.lock:
+            body = self.server.segment_cache.get(index)
+            if body is None:
+                body = self.server.segment_cache[index] = segment_bytes(index, settings['segment_size'])
+        self.send_body(body, 'video/mp2t')
+
+    def send_body(self, body, content_type):
+        status = 200
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[len('bytes='):].partition('-')
+            start = int(first) if first else 0
+            end = min(int(last), end) if last else end
+            if start > end:
+                return self.send_empty(416, {'Content-Range': f'bytes */{len(body)}'})
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.write_paced(memoryview(body)[start:end + 1])
+
+    def write_paced(self, data):
+        """Writes data, no faster than the per-connection bandwidth cap if there is one."""
+        bandwidth = self.server.settings['bandwidth']
+        chunk_size = 64 * 1024
+        started = time.monotonic()
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            try:
+                self.wfile.write(chunk)
+            except (ConnectionResetError, BrokenPipeError):
+                # The downloader closed the connection early, e.g. after reading the first part of a split segment
+                self.close_connection = True
+                return
+            self.server.count('bytes_sent', len(chunk))
+            if bandwidth:
+                ahead = (offset + len(chunk)) / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+def serve(settings, port_queue):
+    """Runs the mock server until the process is terminated. Runs in its own process, so it does not count towards the downloader's RSS."""
+    server = MockCDNServer(('127.0.0.1', 0), settings)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def fetch_server_stats(base_url):
+    import requests
+    return requests.get(base_url + '/stats', timeout=10).json()
+
+# --- Benchmark runs ---
+
+def load_downloader():
+    """Imports the downloader script, whose file name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location("startimes_downloader", DOWNLOADER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def expected_output_hash(settings):
+    """Returns the sha256 the merged video must have: the decoded init data followed by all segments in order."""
+    checksum = hashlib.sha256(INIT_DATA)
+    for i in range(settings['segments']):
+        checksum.update(segment_bytes(i, settings['segment_size']))
+    return checksum.hexdigest()
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None where it cannot be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KB elsewhere
+
+def run_pipeline(downloader, base_url, work_dir, download_args, verbose=False, config=None):
+    """Downloads and merges the mock playlist through the downloader's DownloadJob API. Returns (output file, stats)."""
+    args = downloader.parse_args(download_args + [base_url + '/index.m3u8'])
+    options = {k: v for k, v in vars(args).items() if k not in ('urls', 'batch', 'engine', 'workers')}
+    job = downloader.DownloadJob(args.urls[0], os.path.join(work_dir, 'output.mp4'), engine=args.engine, workers=args.workers,
+                                 quiet=not verbose, config=config or {}, downloads_dir=os.path.join(work_dir, 'downloads'), **options)
+    result = job.run()
+    if not result.total:
+        raise RuntimeError("the playlist could not be prepared")
+    return result.output_file, {
+        'seconds': result.seconds,
+        'combined': os.path.exists(result.output_file),
+        'completed': result.completed,
+        'failed': result.failed,
+        'retries': result.retries,
+        'engine': args.engine
+    }
+
+def run_isolated(base_url, work_dir, download_args, verbose, config, expected_hash, result_queue):
+    """Runs the pipeline once in a fresh process, so the peak RSS it reports is that of this run alone."""
+    try:
+        downloader = load_downloader()
+        output_file, result = run_pipeline(downloader, base_url, work_dir, download_args, verbose, config)
+        size = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+        actual_hash = downloader.hash_file(output_file).hexdigest() if size else None
+        result.update({'size': size, 'verified': actual_hash == expected_hash, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        result = {'error': repr(e)}
+    result_queue.put(result)
+
+def run_in_child(context, *args):
+    """Runs run_isolated in a child process and returns its result dict."""
+    result_queue = context.Queue()
+    process = context.Process(target=run_isolated, args=args + (result_queue,))
+    process.start()
+    try:
+        while True:
+            try:
+                result = result_queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"the benchmark run exited with code {process.exitcode} and no result")
+    finally:
+        process.join()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+def run_benchmark(settings, download_args, runs, verbose=False, keep=False):
+    """Starts the mock server, runs the pipeline `runs` times and returns one result dict per run."""
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(settings, port_queue), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+    expected_hash = expected_output_hash(settings)
+    config = {}
+    if settings['auth_expiry']:
+        # Headers expire during the run and are renewed through the stand-in ad-gslb endpoint
+        config['auth'] = {'token': AUTH_TOKEN, 'url': base_url + '/ad-gslb', 'min_interval': settings['auth_expiry'] / 4}
+    # A fresh interpreter per run, so no run inherits the memory high-water mark of an earlier one
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for run in range(1, runs + 1):
+            work_dir = tempfile.mkdtemp(prefix='startimes-bench-')
+            before = fetch_server_stats(base_url)
+            try:
+                result = run_in_child(context, base_url, work_dir, download_args, verbose, config, expected_hash)
+                after = fetch_server_stats(base_url)
+            finally:
+                if keep:
+                    print(f"Run {run} files kept in {work_dir}")
+                else:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+            size = result.pop('size')
+            result.update({
+                'run': run,
+                'mb': size / (1024 * 1024),
+                'throughput_mbps': size / (1024 * 1024) / max(result['seconds'], 1e-6),
+                'handshakes': after['connections'] - before['connections'] - 1, # minus the /stats request after the run
+                'requests': after['requests'] - before['requests'] - 1,
+                'errors_injected': after['errors_injected'] - before['errors_injected'],
+                'auth_refreshes': after['auth_issued'] - before['auth_issued'],
+                'auth_rejected': after['auth_rejected'] - before['auth_rejected']
+            })
+            results.append(result)
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+def print_results(results):
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f} MB" if r['peak_rss_mb'] is not None else "n/a"
+        print(f"Run {r['run']}: {r['seconds']:.2f}s, {r['mb']:.1f} MB at {r['throughput_mbps']:.2f} MB/s, "
+              f"peak RSS {rss}, {r['handshakes']} handshakes for {r['requests']} requests, "
+              f"{r['completed']} segments, {r['failed']} failed, {r['retries']} retries "
+              f"({r['errors_injected']} errors injected), output {'OK' if r['verified'] else 'MISMATCH'}")
+        if r['auth_refreshes'] or r['auth_rejected']:
+            print(f"       {r['auth_refreshes']} header refreshes, {r['auth_rejected']} requests rejected with 403")
+    if len(results) > 1:
+        print(f"Median: {statistics.median(r['seconds'] for r in results):.2f}s, "
+              f"{statistics.median(r['throughput_mbps'] for r in results):.2f} MB/s")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the StarTimes downloader offline against a local mock HLS/CDN server.",
+        epilog="Options after -- are passed to the downloader, e.g. -- --engine async --stream-merge")
+    parser.add_argument('--segments', type=int, default=200, help="segments in the playlist (default: 200)")
+    parser.add_argument('--segment-size', type=int, default=512 * 1024, help="bytes per segment (default: 524288)")
+    parser.add_argument('--latency', type=float, default=20, metavar='MS', help="time to first byte of a segment (default: 20 ms)")
+    parser.add_argument('--jitter', type=float, default=30, metavar='MS',
+                        help="random extra latency up to MS, so segments complete out of order (default: 30 ms)")
+    parser.add_argument('--bandwidth', type=float, default=0, metavar='BYTES_PER_SECOND',
+                        help="cap per connection (default: unlimited)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of segment requests that fail (default: 0)")
+    parser.add_argument('--error-status', type=int, default=503, help="HTTP status of injected failures (default: 503)")
+    parser.add_argument('--auth-expiry', type=float, default=0, metavar='SECONDS',
+                        help="make request headers expire after SECONDS, so the downloader renews them through a stand-in ad-gslb endpoint (default: never)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for jitter and errors (default: 1)")
+    parser.add_argument('--runs', type=int, default=3, help="number of runs (default: 3)")
+    parser.add_argument('--json', action='store_true', help="print one JSON object per run instead of text")
+    parser.add_argument('--verbose', action='store_true', help="show the downloader's own output")
+    parser.add_argument('--keep', action='store_true', help="keep the downloaded files of each run")
+    argv = sys.argv[1:] if argv is None else argv
+    download_args = []
+    if '--' in argv:
+        download_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    return parser.parse_args(argv), download_args
+
+def main():
+    args, download_args = parse_args()
+    settings = {
+        'segments': args.segments,
+        'segment_size': args.segment_size,
+        'latency': args.latency / 1000,
+        'jitter': args.jitter / 1000,
+        'bandwidth': args.bandwidth,
+        'error_rate': args.error_rate,
+        'error_status': args.error_status,
+        'auth_expiry': args.auth_expiry,
+        'seed': args.seed
+    }
+    results = run_benchmark(settings, download_args, args.runs, args.verbose, args.keep)
+    if args.json:
+        for result in results:
+            print(json.dumps(dict(result, settings=settings, download_args=download_args)))
+    else:
+        print_results(results)
+    sys.exit(0 if all(r['verified'] for r in results) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,21 @@
 import requests
+from urllib.parse import urlparse
 
-def get_program_contents():
-    # User input for Authorization Token (用户输入 Authorization Token)
-    auth_token = input("Please enter Authorization Token (starts with 'Bearer '): \n请输入 Authorization Token（Bearer 开头）：").strip()
-    if not auth_token.lower().startswith("bearer "):
-        print("Error: Authorization must start with 'Bearer ' (错误：Authorization 必须以 'Bearer ' 开头)")
-        return
+AD_GSLB_URL = "https://upms.startimestv.com/play-service/v1/aaa/program-contents/ad-gslb"
 
-    url = "https://upms.startimestv.com/play-service/v1/aaa/program-contents/ad-gslb"
-    params = {
-        "program_id": "16164",
-        "play_id": "1fa2f503-6e1f-4f42-9181-2e78730b653f",
-        "video_limit": "0",
-        "pic_limit": "2",
-        "memory": "L6",
-        "cpu": "8x3.2GHz",
-        "resolution": "1080x2320"
-    }
+# Query parameters of the ad-gslb request, as sent by the Android app (Android 客户端发送的 ad-gslb 请求参数)
+AD_GSLB_PARAMS = {
+    "program_id": "16164",
+    "play_id": "1fa2f503-6e1f-4f42-9181-2e78730b653f",
+    "video_limit": "0",
+    "pic_limit": "2",
+    "memory": "L6",
+    "cpu": "8x3.2GHz",
+    "resolution": "1080x2320"
+}
+
+# Requests ad-gslb with an Authorization token; also used by the downloader to refresh its headers (下载器也用它刷新请求头)
+def request_header_propertys(auth_token, url=AD_GSLB_URL, params=None, timeout=None):
     headers = {
         "Authorization": auth_token,
         "lnCode": "en",
@@ -25,20 +24,30 @@ def get_program_contents():
         "timeZoneId": "Asia/Shanghai",
         "clientType": "android",
         "User-Agent": "StarTimesON/6.16.5(Android)",
-        "Host": "upms.startimestv.com",
+        "Host": urlparse(url).netloc,
         "Connection": "Keep-Alive",
         "Accept-Encoding": "gzip"
     }
 
-    try:
-        # Explicitly disable proxies to avoid VPN or local proxy interference with requests (显式禁用代理，以避免 VPN 或本地代理干扰请求)
-        proxies = {
-            "http": None,
-            "https": None
-        }
+    # Explicitly disable proxies to avoid VPN or local proxy interference with requests (显式禁用代理，以避免 VPN 或本地代理干扰请求)
+    proxies = {
+        "http": None,
+        "https": None
+    }
 
-        response = requests.get(url, headers=headers, params=params, proxies=proxies)
-        response.raise_for_status()  # If the response is not 200, an exception will be raised (如果响应不是 200，会抛出异常)
+    response = requests.get(url, headers=headers, params=params or AD_GSLB_PARAMS, proxies=proxies, timeout=timeout)
+    response.raise_for_status()  # If the response is not 200, an exception will be raised (如果响应不是 200，会抛出异常)
+    return response
+
+def get_program_contents():
+    # User input for Authorization Token (用户输入 Authorization Token)
+    auth_token = input("Please enter Authorization Token (starts with 'Bearer '): \n请输入 Authorization Token（Bearer 开头）：").strip()
+    if not auth_token.lower().startswith("bearer "):
+        print("Error: Authorization must start with 'Bearer ' (错误：Authorization 必须以 'Bearer ' 开头)")
+        return
+
+    try:
+        response = request_header_propertys(auth_token)
 
         data = response.json()
         header_props = data.get("header_propertys")
@@ -52,7 +61,7 @@ def get_program_contents():
 
     except requests.exceptions.HTTPError as http_err:
         print(f"HTTP Error: {http_err} (HTTP 错误: {http_err})")
-        print("Response content: (响应内容：)", response.text)
+        print("Response content: (响应内容：)", http_err.response.text)
     except Exception as err:
         print(f"An error occurred during the request: {err} (请求过程中出现错误: {err})")
 